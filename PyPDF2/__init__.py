@@ -1,5 +1,5 @@
-from .pdf import PdfFileReader, PdfFileWriter
-from .merger import PdfFileMerger
+from .pdf import PdfFileReader, PdfFileWriter, PdfFileStreamWriter
+from .merger import PdfFileMerger, PdfFileStreamMerger
 from .pagerange import PageRange, parse_filename_page_ranges
 from ._version import __version__
-__all__ = ["pdf", "PdfFileMerger"]
+__all__ = ["pdf", "PdfFileMerger", "PdfFileStreamMerger"]
@@ -34,6 +34,7 @@ Implementation of generic PDF objects (dictionary, number, string, and so on)
 __author__ = "Mathieu Fenniak"
 __author_email__ = "biziqe@mathieu.fenniak.net"
 
+import mmap
 import re
 from .utils import readNonWhitespace, RC4_encrypt, skipOverComment
 from .utils import b_, u_, chr_, ord_
@@ -605,7 +606,14 @@ class DictionaryObject(dict, PdfObject):
                 t = stream.tell()
                 length = pdf.getObject(length)
                 stream.seek(t, 0)
-            data["__streamdata__"] = stream.read(length)
+            if isinstance(stream, mmap.mmap):
+                # leave the data in the mapped file until it is used
+                start = stream.tell()
+                length = min(length, len(stream) - start)
+                data["__streamdata__"] = StreamSlice(stream, start, length)
+                stream.seek(start + length, 0)
+            else:
+                data["__streamdata__"] = stream.read(length)
             if debug: print("here")
             #if debug: print(binascii.hexlify(data["__streamdata__"]))
             e = readNonWhitespace(stream)
@@ -622,7 +630,10 @@ class DictionaryObject(dict, PdfObject):
                 end = stream.read(9)
                 if end == b_("endstream"):
                     # we found it by looking back one character further.
-                    data["__streamdata__"] = data["__streamdata__"][:-1]
+                    streamdata = data["__streamdata__"]
+                    if isinstance(streamdata, StreamSlice):
+                        streamdata = streamdata.getData()
+                    data["__streamdata__"] = streamdata[:-1]
                 else:
                     if debug: print(("E", e, ndstream, debugging.toHex(end)))
                     stream.seek(pos, 0)
@@ -769,20 +780,68 @@ class TreeObject(DictionaryObject):
             del self[NameObject('/Last')]
 
 
+class StreamSlice(object):
+    """
+    Stream data left where a reader found it, in a memory-mapped file,
+    until it is used. A document can then be read and written elsewhere
+    while only its objects, not its images and content streams, are held
+    in memory.
+    """
+    chunkSize = 1 << 20
+
+    def __init__(self, source, start, length):
+        self.source = source
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def getData(self):
+        return self.source[self.start:self.start + self.length]
+
+    def chunks(self):
+        end = self.start + self.length
+        for start in range(self.start, end, self.chunkSize):
+            yield self.source[start:min(start + self.chunkSize, end)]
+
+    def writeToStream(self, stream):
+        for chunk in self.chunks():
+            stream.write(chunk)
+
+
 class StreamObject(DictionaryObject):
+    # the data as read or set: bytes, or a StreamSlice that is read each time it is used
+    _rawData = None
+
     def __init__(self):
         self._data = None
         self.decodedSelf = None
 
+    def _readData(self):
+        if isinstance(self._rawData, StreamSlice):
+            return self._rawData.getData()
+        return self._rawData
+
+    def _storeData(self, data):
+        self._rawData = data
+
+    _data = property(_readData, _storeData)
+
     def writeToStream(self, stream, encryption_key):
-        self[NameObject("/Length")] = NumberObject(len(self._data))
+        data = self._rawData
+        if encryption_key or not isinstance(data, StreamSlice):
+            data = self._data
+        self[NameObject("/Length")] = NumberObject(len(data))
         DictionaryObject.writeToStream(self, stream, encryption_key)
         del self["/Length"]
         stream.write(b_("\nstream\n"))
-        data = self._data
         if encryption_key:
             data = RC4_encrypt(encryption_key, data)
-        stream.write(data)
+        if isinstance(data, StreamSlice):
+            data.writeToStream(stream)
+        else:
+            stream.write(data)
         stream.write(b_("\nendstream"))
 
     def initializeFromDictionary(data):
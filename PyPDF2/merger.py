@@ -28,9 +28,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from .generic import *
-from .utils import isString, str_
-from .pdf import PdfFileReader, PdfFileWriter
+from .utils import isString, str_, mapFile
+from .pdf import PdfFileReader, PdfFileWriter, PdfFileStreamWriter
 from .pagerange import PageRange
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
 from sys import version_info
 if version_info < ( 3, 0 ):
     from cStringIO import StringIO
@@ -41,6 +45,21 @@ else:
     StreamIO = BytesIO
 
 
+def _page_key(page):
+    """
+    Identifies a page of a source document by its reference rather than by
+    comparing page dictionaries, which is slow and can match equal but
+    distinct pages. Destinations and bookmarks point at pages through
+    references; the pages of a reader keep theirs in ``indirectRef``.
+    """
+    if isinstance(page, IndirectObject):
+        return (page.idnum, page.generation)
+    ref = getattr(page, 'indirectRef', None)
+    if ref is not None:
+        return (ref.idnum, ref.generation)
+    return id(page)
+
+
 class _MergedPage(object):
     """
     _MergedPage is used internally by PdfFileMerger to collect necessary
@@ -65,16 +84,33 @@ class PdfFileMerger(object):
     :param bool strict: Determines whether user should be warned of all
             problems and also causes some correctable problems to be fatal.
             Defaults to ``True``.
+
+    :param bool dedup: Write objects that are the same in several of the
+            merged files, such as a shared image or font, only once.
+            Defaults to ``False``.
+
+    :param bool map_inputs: Memory-map input files instead of copying them
+            into memory, and read their stream data only when the output is
+            written, so memory use does not grow with the size of the
+            inputs. The input files must then not be changed or truncated
+            by anything else until the output is written: the operating
+            system reports reading a mapped file that has shrunk with a
+            signal that ends the process, not an exception. Writing the
+            output to the path of one of its inputs is safe; the output
+            then replaces the input file when it is complete.
+            Defaults to ``False``.
     """
 
-    def __init__(self, strict=True):
+    def __init__(self, strict=True, dedup=False, map_inputs=False):
         self.inputs = []
         self.pages = []
-        self.output = PdfFileWriter()
+        self.output = PdfFileWriter(dedup)
         self.bookmarks = []
         self.named_dests = []
         self.id_count = 0
         self.strict = strict
+        self.map_inputs = map_inputs
+        self.mapped_files = set()  # (device, inode) of each mapped input
 
     def merge(self, position, fileobj, bookmark=None, pages=None, import_bookmarks=True):
         """
@@ -99,6 +135,15 @@ class PdfFileMerger(object):
             from being imported by specifying this as ``False``.
         """
 
+        self._attach(position, self._prepare(fileobj, pages, import_bookmarks), bookmark)
+
+    def _prepare(self, fileobj, pages=None, import_bookmarks=True):
+        """
+        Opens and reads a file to be merged, and finds the pages, bookmarks
+        and named destinations to merge from it. Uses nothing of the
+        merger's state but its settings, so several files can be prepared
+        at once; :meth:`_attach()<_attach>` then merges them in order.
+        """
         # This parameter is passed to self.inputs.append and means
         # that the stream used was created in this method.
         my_file = False
@@ -108,25 +153,42 @@ class PdfFileMerger(object):
         # copy the file's contents into a BytesIO (or StreamIO) stream object; if
         # it is a PdfFileReader, copy that reader's stream into a
         # BytesIO (or StreamIO) stream.
+        # With map_inputs, files given any of these ways, or as any other
+        # object with a file descriptor, are memory-mapped instead, so stream
+        # data stays in the file until the merged document is written; a
+        # file that cannot be mapped is handled as without map_inputs.
         # If fileobj is none of the above types, it is not modified
         decryption_key = None
+        mapped = None
         if isString(fileobj):
             fileobj = file(fileobj, 'rb')
-            my_file = True
-        elif isinstance(fileobj, file):
-            fileobj.seek(0)
-            filecontent = fileobj.read()
-            fileobj = StreamIO(filecontent)
+            mapped = self._map_input(fileobj)
+            if mapped is not None:
+                # the map keeps its own handle to the file
+                fileobj.close()
+                fileobj = mapped
             my_file = True
         elif isinstance(fileobj, PdfFileReader):
-            orig_tell = fileobj.stream.tell()
-            fileobj.stream.seek(0)
-            filecontent = StreamIO(fileobj.stream.read())
-            fileobj.stream.seek(orig_tell) # reset the stream to its original location
-            fileobj = filecontent
+            mapped = self._map_input(fileobj.stream)
+            if mapped is None:
+                orig_tell = fileobj.stream.tell()
+                fileobj.stream.seek(0)
+                mapped = StreamIO(fileobj.stream.read())
+                fileobj.stream.seek(orig_tell) # reset the stream to its original location
+            fileobj = mapped
             if hasattr(fileobj, '_decryption_key'):
                 decryption_key = fileobj._decryption_key
             my_file = True
+        else:
+            mapped = self._map_input(fileobj)
+            if mapped is not None:
+                fileobj = mapped
+                my_file = True
+            elif isinstance(fileobj, file):
+                fileobj.seek(0)
+                filecontent = fileobj.read()
+                fileobj = StreamIO(filecontent)
+                my_file = True
 
         # Create a new PdfFileReader instance using the stream
         # (either file or BytesIO or StringIO) created above
@@ -142,28 +204,51 @@ class PdfFileMerger(object):
         elif not isinstance(pages, tuple):
             raise TypeError('"pages" must be a tuple of (start, stop[, step])')
 
-        srcpages = []
-        if bookmark:
-            bookmark = Bookmark(TextStringObject(bookmark), NumberObject(self.id_count), NameObject('/Fit'))
-
         outline = []
         if import_bookmarks:
             outline = pdfr.getOutlines()
             outline = self._trim_outline(pdfr, outline, pages)
 
+        dests = pdfr.namedDestinations
+        dests = self._trim_dests(pdfr, dests, pages)
+
+        # Gather all the pages that are going to be merged
+        srcpages = [pdfr.getPage(i) for i in range(*pages)]
+
+        return (fileobj, pdfr, my_file, srcpages, outline, dests)
+
+    def _map_input(self, fileobj):
+        """
+        Memory-maps an input file if :attr:`map_inputs` is set and the file
+        can be mapped, and remembers which file it is so that
+        :meth:`write()<write>` does not write over it. Returns ``None``
+        otherwise.
+        """
+        if not self.map_inputs:
+            return None
+        mapped = mapFile(fileobj)
+        if mapped is not None:
+            stat = os.fstat(fileobj.fileno())
+            self.mapped_files.add((stat.st_dev, stat.st_ino))
+        return mapped
+
+    def _attach(self, position, prepared, bookmark=None):
+        """
+        Merges a file read by :meth:`_prepare()<_prepare>` at the given
+        page number, under the given bookmark.
+        """
+        fileobj, pdfr, my_file, pagedata, outline, dests = prepared
+
+        srcpages = []
         if bookmark:
+            bookmark = Bookmark(TextStringObject(bookmark), NumberObject(self.id_count), NameObject('/Fit'))
             self.bookmarks += [bookmark, outline]
         else:
             self.bookmarks += outline
 
-        dests = pdfr.namedDestinations
-        dests = self._trim_dests(pdfr, dests, pages)
         self.named_dests += dests
 
-        # Gather all the pages that are going to be merged
-        for i in range(*pages):
-            pg = pdfr.getPage(i)
-
+        for pg in pagedata:
             id = self.id_count
             self.id_count += 1
 
@@ -171,8 +256,9 @@ class PdfFileMerger(object):
 
             srcpages.append(mp)
 
-        self._associate_dests_to_pages(srcpages)
-        self._associate_bookmarks_to_pages(srcpages)
+        # Only the destinations and bookmarks of this file can point at its pages
+        self._associate_dests_to_pages(srcpages, dests)
+        self._associate_bookmarks_to_pages(srcpages, outline)
 
         # Slice to insert the pages at the specified position
         self.pages[position:position] = srcpages
@@ -202,6 +288,51 @@ class PdfFileMerger(object):
 
         self.merge(len(self.pages), fileobj, bookmark, pages, import_bookmarks)
 
+    def appendMany(self, fileobjs, bookmarks=None, jobs=4, import_bookmarks=True):
+        """
+        Appends all pages of several files like :meth:`append()<append>`,
+        but opens and reads up to ``jobs`` files at once on a pool of
+        threads. The files are still appended in the order given, each as
+        soon as it and the files before it have been read, so no more than
+        about twice ``jobs`` files are open and waiting at a time.
+
+        Reading overlaps waiting on the disk; parsing itself holds the
+        interpreter lock, so it gains less.
+
+        :param fileobjs: Files to append, each as for :meth:`append()<append>`.
+
+        :param bookmarks: Optionally, a bookmark title (or ``None``) for
+            each file. Raises ``ValueError`` if there are not as many
+            bookmarks as files.
+
+        :param int jobs: Number of files read at once.
+
+        :param bool import_bookmarks: You may prevent the source documents' bookmarks
+            from being imported by specifying this as ``False``.
+        """
+        fileobjs = list(fileobjs)
+        if bookmarks == None:
+            bookmarks = [None] * len(fileobjs)
+        else:
+            bookmarks = list(bookmarks)
+            if len(bookmarks) != len(fileobjs):
+                raise ValueError("%d bookmarks given for %d files" % (len(bookmarks), len(fileobjs)))
+
+        pool = ThreadPool(jobs)
+        try:
+            pending = deque()
+            for fileobj, bookmark in zip(fileobjs, bookmarks):
+                pending.append((pool.apply_async(self._prepare, (fileobj, None, import_bookmarks)), bookmark))
+                if len(pending) >= 2 * jobs:
+                    prepared, bookmark = pending.popleft()
+                    self._attach(len(self.pages), prepared.get(), bookmark)
+            while pending:
+                prepared, bookmark = pending.popleft()
+                self._attach(len(self.pages), prepared.get(), bookmark)
+        finally:
+            pool.close()
+            pool.join()
+
     def write(self, fileobj):
         """
         Writes all data that has been merged to the given output file.
@@ -210,17 +341,24 @@ class PdfFileMerger(object):
             file-like object.
         """
         my_file = False
+        replaces = None
         if isString(fileobj):
+            if self._is_mapped(fileobj):
+                # Truncating a mapped input would end the process the next time its data is read, so
+                # write next to it and replace it when done; the maps keep the old file until closed
+                fd, replaces = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileobj)))
+                os.close(fd)
+                fileobj, replaces = replaces, fileobj
             fileobj = file(fileobj, 'wb')
             my_file = True
 
         # Add pages to the PdfFileWriter
-        # The commented out line below was replaced with the two lines below it to allow PdfFileMerger to work with PyPdf 1.13
+        # The reference addPage appends to /Kids is the page's reference; looking it up again with getReference
+        # would search and compare every object written so far, once per page
+        kids = self.output._pages.getObject()["/Kids"]
         for page in self.pages:
             self.output.addPage(page.pagedata)
-            page.out_pagedata = self.output.getReference(self.output._pages.getObject()["/Kids"][-1].getObject())
-            #idnum = self.output._objects.index(self.output._pages.getObject()["/Kids"][-1].getObject()) + 1
-            #page.out_pagedata = IndirectObject(idnum, 0, self.output)
+            page.out_pagedata = kids[-1]
 
         # Once all pages are added, create bookmarks to point at those pages
         self._write_dests()
@@ -231,6 +369,18 @@ class PdfFileMerger(object):
 
         if my_file:
             fileobj.close()
+        if replaces is not None:
+            os.rename(fileobj.name, replaces)
+
+    def _is_mapped(self, filename):
+        """
+        Tells whether the file at a path is one of the memory-mapped inputs.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) in self.mapped_files
 
     def close(self):
         """
@@ -295,153 +445,166 @@ class PdfFileMerger(object):
         """
         new_dests = []
         prev_header_added = True
+        page_keys = self._page_keys(pdf, pages)
         for k, o in list(dests.items()):
-            for j in range(*pages):
-                if pdf.getPage(j).getObject() == o['/Page'].getObject():
-                    o[NameObject('/Page')] = o['/Page'].getObject()
-                    assert str_(k) == str_(o['/Title'])
-                    new_dests.append(o)
-                    break
+            if _page_key(o.raw_get('/Page')) in page_keys:
+                assert str_(k) == str_(o['/Title'])
+                new_dests.append(o)
         return new_dests
 
-    def _trim_outline(self, pdf, outline, pages):
+    def _trim_outline(self, pdf, outline, pages, page_keys=None):
         """
         Removes any outline/bookmark entries that are not a part of the
         specified page set.
         """
+        if page_keys is None:
+            page_keys = self._page_keys(pdf, pages)
         new_outline = []
         prev_header_added = True
         for i, o in enumerate(outline):
             if isinstance(o, list):
-                sub = self._trim_outline(pdf, o, pages)
+                sub = self._trim_outline(pdf, o, pages, page_keys)
                 if sub:
                     if not prev_header_added:
                         new_outline.append(outline[i-1])
                     new_outline.append(sub)
             else:
                 prev_header_added = False
-                for j in range(*pages):
-                    if pdf.getPage(j).getObject() == o['/Page'].getObject():
-                        o[NameObject('/Page')] = o['/Page'].getObject()
-                        new_outline.append(o)
-                        prev_header_added = True
-                        break
+                if _page_key(o.raw_get('/Page')) in page_keys:
+                    new_outline.append(o)
+                    prev_header_added = True
         return new_outline
 
+    def _page_keys(self, pdf, pages):
+        """
+        Returns the keys (see :func:`_page_key`) of the pages in the
+        specified page set.
+        """
+        return set([_page_key(pdf.getPage(j)) for j in range(*pages)])
+
     def _write_dests(self):
         dests = self.named_dests
+        pages_by_id = self._pages_by_id()
 
         for v in dests:
             pageno = None
             pdf = None
-            if '/Page' in v:
-                for i, p in enumerate(self.pages):
-                    if p.id == v['/Page']:
-                        v[NameObject('/Page')] = p.out_pagedata
-                        pageno = i
-                        pdf = p.src
-                        break
+            if '/Page' in v and v['/Page'] in pages_by_id:
+                i, p = pages_by_id[v['/Page']]
+                v[NameObject('/Page')] = p.out_pagedata
+                pageno = i
+                pdf = p.src
             if pageno != None:
                 self.output.addNamedDestinationObject(v)
 
-    def _write_bookmarks(self, bookmarks=None, parent=None):
+    def _pages_by_id(self):
+        """
+        Maps the id of each merged page to its position and :class:`_MergedPage`.
+        """
+        return dict([(p.id, (i, p)) for i, p in enumerate(self.pages)])
+
+    def _write_bookmarks(self, bookmarks=None, parent=None, pages_by_id=None):
 
         if bookmarks == None:
             bookmarks = self.bookmarks
+        if pages_by_id is None:
+            pages_by_id = self._pages_by_id()
 
         last_added = None
         for b in bookmarks:
             if isinstance(b, list):
-                self._write_bookmarks(b, last_added)
+                self._write_bookmarks(b, last_added, pages_by_id)
                 continue
 
             pageno = None
             pdf = None
-            if '/Page' in b:
-                for i, p in enumerate(self.pages):
-                    if p.id == b['/Page']:
-                        #b[NameObject('/Page')] = p.out_pagedata
-                        args = [NumberObject(p.id), NameObject(b['/Type'])]
-                        #nothing more to add
-                        #if b['/Type'] == '/Fit' or b['/Type'] == '/FitB'
-                        if b['/Type'] == '/FitH' or b['/Type'] == '/FitBH':
-                            if '/Top' in b and not isinstance(b['/Top'], NullObject):
-                                args.append(FloatObject(b['/Top']))
-                            else:
-                                args.append(FloatObject(0))
-                            del b['/Top']
-                        elif b['/Type'] == '/FitV' or b['/Type'] == '/FitBV':
-                            if '/Left' in b and not isinstance(b['/Left'], NullObject):
-                                args.append(FloatObject(b['/Left']))
-                            else:
-                                args.append(FloatObject(0))
-                            del b['/Left']
-                        elif b['/Type'] == '/XYZ':
-                            if '/Left' in b and not isinstance(b['/Left'], NullObject):
-                                args.append(FloatObject(b['/Left']))
-                            else:
-                                args.append(FloatObject(0))
-                            if '/Top' in b and not isinstance(b['/Top'], NullObject):
-                                args.append(FloatObject(b['/Top']))
-                            else:
-                                args.append(FloatObject(0))
-                            if '/Zoom' in b and not isinstance(b['/Zoom'], NullObject):
-                                args.append(FloatObject(b['/Zoom']))
-                            else:
-                                args.append(FloatObject(0))
-                            del b['/Top'], b['/Zoom'], b['/Left']
-                        elif b['/Type'] == '/FitR':
-                            if '/Left' in b and not isinstance(b['/Left'], NullObject):
-                                args.append(FloatObject(b['/Left']))
-                            else:
-                                args.append(FloatObject(0))
-                            if '/Bottom' in b and not isinstance(b['/Bottom'], NullObject):
-                                args.append(FloatObject(b['/Bottom']))
-                            else:
-                                args.append(FloatObject(0))
-                            if '/Right' in b and not isinstance(b['/Right'], NullObject):
-                                args.append(FloatObject(b['/Right']))
-                            else:
-                                args.append(FloatObject(0))
-                            if '/Top' in b and not isinstance(b['/Top'], NullObject):
-                                args.append(FloatObject(b['/Top']))
-                            else:
-                                args.append(FloatObject(0))
-                            del b['/Left'], b['/Right'], b['/Bottom'], b['/Top']
-
-                        b[NameObject('/A')] = DictionaryObject({NameObject('/S'): NameObject('/GoTo'), NameObject('/D'): ArrayObject(args)})
-
-                        pageno = i
-                        pdf = p.src
-                        break
+            if '/Page' in b and b['/Page'] in pages_by_id:
+                i, p = pages_by_id[b['/Page']]
+                #b[NameObject('/Page')] = p.out_pagedata
+                args = [NumberObject(p.id), NameObject(b['/Type'])]
+                #nothing more to add
+                #if b['/Type'] == '/Fit' or b['/Type'] == '/FitB'
+                if b['/Type'] == '/FitH' or b['/Type'] == '/FitBH':
+                    if '/Top' in b and not isinstance(b['/Top'], NullObject):
+                        args.append(FloatObject(b['/Top']))
+                    else:
+                        args.append(FloatObject(0))
+                    del b['/Top']
+                elif b['/Type'] == '/FitV' or b['/Type'] == '/FitBV':
+                    if '/Left' in b and not isinstance(b['/Left'], NullObject):
+                        args.append(FloatObject(b['/Left']))
+                    else:
+                        args.append(FloatObject(0))
+                    del b['/Left']
+                elif b['/Type'] == '/XYZ':
+                    if '/Left' in b and not isinstance(b['/Left'], NullObject):
+                        args.append(FloatObject(b['/Left']))
+                    else:
+                        args.append(FloatObject(0))
+                    if '/Top' in b and not isinstance(b['/Top'], NullObject):
+                        args.append(FloatObject(b['/Top']))
+                    else:
+                        args.append(FloatObject(0))
+                    if '/Zoom' in b and not isinstance(b['/Zoom'], NullObject):
+                        args.append(FloatObject(b['/Zoom']))
+                    else:
+                        args.append(FloatObject(0))
+                    del b['/Top'], b['/Zoom'], b['/Left']
+                elif b['/Type'] == '/FitR':
+                    if '/Left' in b and not isinstance(b['/Left'], NullObject):
+                        args.append(FloatObject(b['/Left']))
+                    else:
+                        args.append(FloatObject(0))
+                    if '/Bottom' in b and not isinstance(b['/Bottom'], NullObject):
+                        args.append(FloatObject(b['/Bottom']))
+                    else:
+                        args.append(FloatObject(0))
+                    if '/Right' in b and not isinstance(b['/Right'], NullObject):
+                        args.append(FloatObject(b['/Right']))
+                    else:
+                        args.append(FloatObject(0))
+                    if '/Top' in b and not isinstance(b['/Top'], NullObject):
+                        args.append(FloatObject(b['/Top']))
+                    else:
+                        args.append(FloatObject(0))
+                    del b['/Left'], b['/Right'], b['/Bottom'], b['/Top']
+
+                b[NameObject('/A')] = DictionaryObject({NameObject('/S'): NameObject('/GoTo'), NameObject('/D'): ArrayObject(args)})
+
+                pageno = i
+                pdf = p.src
             if pageno != None:
                 del b['/Page'], b['/Type']
                 last_added = self.output.addBookmarkDict(b, parent)
 
-    def _associate_dests_to_pages(self, pages):
-        for nd in self.named_dests:
+    def _associate_dests_to_pages(self, pages, dests=None):
+        if dests == None:
+            dests = self.named_dests
+        page_ids = dict([(_page_key(p.pagedata), p.id) for p in pages])
+
+        for nd in dests:
             pageno = None
             np = nd['/Page']
 
             if isinstance(np, NumberObject):
                 continue
 
-            for p in pages:
-                if np.getObject() == p.pagedata.getObject():
-                    pageno = p.id
+            pageno = page_ids.get(_page_key(nd.raw_get('/Page')))
 
             if pageno != None:
                 nd[NameObject('/Page')] = NumberObject(pageno)
             else:
                 raise ValueError("Unresolved named destination '%s'" % (nd['/Title'],))
 
-    def _associate_bookmarks_to_pages(self, pages, bookmarks=None):
+    def _associate_bookmarks_to_pages(self, pages, bookmarks=None, page_ids=None):
         if bookmarks == None:
             bookmarks = self.bookmarks
+        if page_ids is None:
+            page_ids = dict([(_page_key(p.pagedata), p.id) for p in pages])
 
         for b in bookmarks:
             if isinstance(b, list):
-                self._associate_bookmarks_to_pages(pages, b)
+                self._associate_bookmarks_to_pages(pages, b, page_ids)
                 continue
 
             pageno = None
@@ -450,9 +613,7 @@ class PdfFileMerger(object):
             if isinstance(bp, NumberObject):
                 continue
 
-            for p in pages:
-                if bp.getObject() == p.pagedata.getObject():
-                    pageno = p.id
+            pageno = page_ids.get(_page_key(b.raw_get('/Page')))
 
             if pageno != None:
                 b[NameObject('/Page')] = NumberObject(pageno)
@@ -516,6 +677,102 @@ class PdfFileMerger(object):
         self.named_dests.append(dest)
 
 
+class PdfFileStreamMerger(PdfFileMerger):
+    """
+    Initializes a PdfFileStreamMerger object. Like :class:`PdfFileMerger<PdfFileMerger>`,
+    but the pages of each file, and the objects they use, are written to the
+    output as soon as the file is merged, and the file is closed then.
+    Memory use and open files then stay the same however many files are
+    merged.
+
+    Files can still be merged at any position, and bookmarks, named
+    destinations and metadata added, until :meth:`close()<close>` finishes
+    the output.
+
+    :param fileobj: Output file. Can be a filename or any kind of
+        file-like object that supports the write and tell methods.
+    :param bool strict: Determines whether user should be warned of all
+            problems and also causes some correctable problems to be fatal.
+            Defaults to ``True``.
+
+    :param bool dedup: Write objects that are the same in several of the
+            merged files, such as a shared image or font, only once.
+            Defaults to ``False``.
+
+    :param bool map_inputs: Memory-map input files instead of copying them
+            into memory, as for :class:`PdfFileMerger`. The output file must
+            not be one of the inputs.
+            Defaults to ``False``.
+    """
+
+    def __init__(self, fileobj, strict=True, dedup=False, map_inputs=False):
+        PdfFileMerger.__init__(self, strict, map_inputs=map_inputs)
+        self.my_file = False
+        if isString(fileobj):
+            fileobj = file(fileobj, 'wb')
+            self.my_file = True
+        self.fileobj = fileobj
+        self.output = PdfFileStreamWriter(fileobj, dedup)
+
+    def _attach(self, position, prepared, bookmark=None):
+        """
+        Merges a file read by :meth:`_prepare()<PdfFileMerger._prepare>`
+        like :class:`PdfFileMerger<PdfFileMerger>` does, then writes its
+        pages to the output and closes the file if it was opened here.
+        """
+        before = len(self.pages)
+        PdfFileMerger._attach(self, position, prepared, bookmark)
+        start = slice(position, position).indices(before)[0]
+
+        # Pages are added to the page tree in the order they are merged in; close() puts them in order
+        kids = self.output._pages.getObject()["/Kids"]
+        for page in self.pages[start:start + len(self.pages) - before]:
+            self.output.addPage(page.pagedata)
+            page.out_pagedata = kids[-1]
+            # bookmarks and destinations only need the page's new reference
+            page.pagedata = None
+            page.src = None
+        self.output.flush()
+
+        fo, pdfr, mine = self.inputs.pop()
+        if mine:
+            fo.close()
+
+    def write(self, fileobj):
+        """
+        Finishes the output like :meth:`close()<close>`. The merged pages
+        are already in the output given to the constructor, so that is the
+        only file it can be written to.
+
+        :param fileobj: The output given to the constructor, as a file
+            object or as the same filename.
+        :raises ValueError: if ``fileobj`` is another file.
+        """
+        if isString(fileobj):
+            same = self.my_file and os.path.abspath(fileobj) == os.path.abspath(self.fileobj.name)
+        else:
+            same = fileobj is self.fileobj
+        if not same:
+            raise ValueError("PdfFileStreamMerger writes to the file it was created with; use close() to finish it")
+        self.close()
+
+    def close(self):
+        """
+        Writes the bookmarks, named destinations and page tree, which
+        finishes the output, and closes the output if it was given as a
+        filename.
+        """
+        if self.output is None:
+            return
+        self._write_dests()
+        self._write_bookmarks()
+        self.output._pages.getObject()[NameObject("/Kids")] = ArrayObject([page.out_pagedata for page in self.pages])
+        self.output.close()
+        if self.my_file:
+            self.fileobj.close()
+        PdfFileMerger.close(self)
+
+
 class OutlinesObject(list):
     def __init__(self, pdf, tree, parent=None):
         list.__init__(self)
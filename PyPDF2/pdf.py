@@ -72,7 +72,7 @@ if version_info < ( 2, 4 ):
 if version_info < ( 2, 5 ):
     from md5 import md5
 else:
-    from hashlib import md5
+    from hashlib import md5, sha256
 import uuid
 
 
@@ -80,10 +80,19 @@ class PdfFileWriter(object):
     """
     This class supports writing PDF files out, given pages produced by another
     class (typically :class:`PdfFileReader<PdfFileReader>`).
+
+    :param bool dedup: Write objects that are the same byte for byte, such as
+        an image or font copied from several documents, only once. Pages, the
+        page tree, the catalog and objects in reference cycles are always
+        written as they are. Defaults to ``False``.
     """
-    def __init__(self):
+    def __init__(self, dedup=False):
         self._header = b_("%PDF-1.3")
         self._objects = []  # array of indirect objects
+        self._idnums = {}  # id() of each object added with _addObject => its object number
+        self._dedup = dedup
+        self._digests = {}  # digest of each distinct object written => its object number
+        self._duplicates = {}  # object number of a duplicate => object number of the object written instead
 
         # The root of our page tree node.
         pages = DictionaryObject()
@@ -112,6 +121,7 @@ class PdfFileWriter(object):
 
     def _addObject(self, obj):
         self._objects.append(obj)
+        self._idnums[id(obj)] = len(self._objects)
         return IndirectObject(len(self._objects), 0, self)
 
     def getObject(self, ido):
@@ -452,7 +462,6 @@ class PdfFileWriter(object):
         if hasattr(stream, 'mode') and 'b' not in stream.mode:
             warnings.warn("File <%s> to write to is not in binary mode. It may not be written to correctly." % stream.name)
         debug = False
-        import struct
 
         if not self._root:
             self._root = self._addObject(self._root_object)
@@ -477,37 +486,177 @@ class PdfFileWriter(object):
                     externalReferenceMap[data.pdf][data.generation] = {}
                 externalReferenceMap[data.pdf][data.generation][data.idnum] = IndirectObject(objIndex + 1, 0, self)
 
-        self.stack = []
+        # ids of the objects swept so far; a set, since it is checked for every reference
+        self.stack = set()
         if debug: print(("ERM:", externalReferenceMap, "root:", self._root))
         self._sweepIndirectReferences(externalReferenceMap, self._root)
         del self.stack
 
+        if self._dedup:
+            self._deduplicate(range(1, len(self._objects) + 1))
+
         # Begin writing:
         object_positions = []
         stream.write(self._header + b_("\n"))
         for i in range(len(self._objects)):
-            idnum = (i + 1)
-            obj = self._objects[i]
+            if i + 1 in self._duplicates:
+                object_positions.append(None)
+                continue
             object_positions.append(stream.tell())
-            stream.write(b_(str(idnum) + " 0 obj\n"))
-            key = None
-            if hasattr(self, "_encrypt") and idnum != self._encrypt.idnum:
-                pack1 = struct.pack("<i", i + 1)[:3]
-                pack2 = struct.pack("<i", 0)[:2]
-                key = self._encrypt_key + pack1 + pack2
-                assert len(key) == (len(self._encrypt_key) + 5)
-                md5_hash = md5(key).digest()
-                key = md5_hash[:min(16, len(self._encrypt_key) + 5)]
-            obj.writeToStream(stream, key)
-            stream.write(b_("\nendobj\n"))
+            self._writeObject(stream, i + 1)
+        self._writeTrailer(stream, object_positions)
 
-        # xref table
+    def _deduplicate(self, idnums):
+        """
+        Finds the objects numbered in idnums that are the same as an object
+        found before, once their own references point at the objects that
+        are written, and points every reference to them at that object.
+        Objects are compared by a digest of how they are written, so they
+        are compared after the objects they refer to, in the order of
+        Tarjan's algorithm for strongly connected components.
+        """
+        excluded = set([self._pages.idnum, self._info.idnum])
+        if self._root:
+            excluded.add(self._root.idnum)
+        if hasattr(self, "_encrypt"):
+            excluded.add(self._encrypt.idnum)
+        candidates = set()
+        for idnum in idnums:
+            obj = self._objects[idnum - 1]
+            if obj is None or idnum in excluded or idnum in self._duplicates:
+                continue
+            if isinstance(obj, DictionaryObject) and obj.get("/Type") in ("/Page", "/Pages", "/Catalog"):
+                continue
+            candidates.add(idnum)
+        references = {}
+        for idnum in candidates:
+            references[idnum] = [ref for ref in self._remapReferences(self._objects[idnum - 1]) if ref in candidates]
+
+        # strongly connected components, each after the components it refers to
+        components = []
+        index = {}
+        low = {}
+        stack = []
+        onStack = set()
+        for start in sorted(candidates):
+            if start in index:
+                continue
+            index[start] = low[start] = len(index)
+            stack.append(start)
+            onStack.add(start)
+            work = [(start, iter(references[start]))]
+            while work:
+                v, refs = work[-1]
+                for w in refs:
+                    if w not in index:
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        onStack.add(w)
+                        work.append((w, iter(references[w])))
+                        break
+                    elif w in onStack:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            onStack.discard(w)
+                            component.append(w)
+                            if w == v:
+                                break
+                        components.append(component)
+
+        for component in components:
+            for idnum in component:
+                self._remapReferences(self._objects[idnum - 1])
+            idnum = component[0]
+            if len(component) > 1 or idnum in references[idnum]:
+                # a cycle; its objects keep their own numbers
+                continue
+            digest = self._objectDigest(self._objects[idnum - 1])
+            if digest in self._digests:
+                self._duplicates[idnum] = self._digests[digest]
+            else:
+                self._digests[digest] = idnum
+
+        for idnum in idnums:
+            if idnum not in candidates and self._objects[idnum - 1] is not None:
+                self._remapReferences(self._objects[idnum - 1])
+
+    # Points the references in an object, not following them, at the objects written instead of duplicates
+    # Returns the numbers of the objects referred to
+    def _remapReferences(self, obj):
+        refs = []
+        containers = [obj]
+        while containers:
+            container = containers.pop()
+            if isinstance(container, DictionaryObject):
+                items = list(container.items())
+            elif isinstance(container, ArrayObject):
+                items = list(enumerate(container))
+            else:
+                continue
+            for key, value in items:
+                if isinstance(value, IndirectObject) and value.pdf is self:
+                    if value.idnum in self._duplicates:
+                        value = IndirectObject(self._duplicates[value.idnum], 0, self)
+                        container[key] = value
+                    refs.append(value.idnum)
+                elif isinstance(value, (DictionaryObject, ArrayObject)):
+                    containers.append(value)
+        return refs
+
+    def _objectDigest(self, obj):
+        out = BytesIO()
+        if isinstance(obj, StreamObject):
+            DictionaryObject.writeToStream(obj, out, None)
+            data = obj._rawData
+            if not isinstance(data, StreamSlice):
+                data = obj._data
+            digest = sha256(out.getvalue())
+            digest.update(b_("\nstream %s\n" % len(data)))
+            if isinstance(data, StreamSlice):
+                for chunk in data.chunks():
+                    digest.update(chunk)
+            else:
+                digest.update(data)
+        else:
+            obj.writeToStream(out, None)
+            digest = sha256(out.getvalue())
+        return digest.digest()
+
+    def _writeObject(self, stream, idnum):
+        obj = self._objects[idnum - 1]
+        stream.write(b_(str(idnum) + " 0 obj\n"))
+        key = None
+        if hasattr(self, "_encrypt") and idnum != self._encrypt.idnum:
+            pack1 = struct.pack("<i", idnum)[:3]
+            pack2 = struct.pack("<i", 0)[:2]
+            key = self._encrypt_key + pack1 + pack2
+            assert len(key) == (len(self._encrypt_key) + 5)
+            md5_hash = md5(key).digest()
+            key = md5_hash[:min(16, len(self._encrypt_key) + 5)]
+        obj.writeToStream(stream, key)
+        stream.write(b_("\nendobj\n"))
+
+    def _writeTrailer(self, stream, object_positions):
+        # xref table; the numbers of duplicates that were not written are free, each entry linking to the next
+        free = [idnum for idnum, offset in enumerate(object_positions, 1) if offset is None]
+        nextFree = dict(zip([0] + free, free + [0]))
         xref_location = stream.tell()
         stream.write(b_("xref\n"))
         stream.write(b_("0 %s\n" % (len(self._objects) + 1)))
-        stream.write(b_("%010d %05d f \n" % (0, 65535)))
-        for offset in object_positions:
-            stream.write(b_("%010d %05d n \n" % (offset, 0)))
+        stream.write(b_("%010d %05d f \n" % (nextFree[0], 65535)))
+        for idnum, offset in enumerate(object_positions, 1):
+            if offset is None:
+                stream.write(b_("%010d %05d f \n" % (nextFree[idnum], 1)))
+            else:
+                stream.write(b_("%010d %05d n \n" % (offset, 0)))
 
         # trailer
         stream.write(b_("trailer\n"))
@@ -539,40 +688,59 @@ class PdfFileWriter(object):
         self.getObject(self._info).update(args)
 
     def _sweepIndirectReferences(self, externMap, data):
+        # Sweeps depth first like a recursive walk would, but with a stack of the dictionaries and arrays
+        # being swept, since long chains of references (e.g. the /Next links of thousands of bookmarks)
+        # would exceed the recursion limit.
+        # Each entry is [container, its (key, value) items, index of the next item, (parent, key) or None]
+        sweeping = []
+        data = self._sweepValue(externMap, data, sweeping)
+        while sweeping:
+            entry = sweeping[-1]
+            container, items, i, parent = entry
+            if i == len(items):
+                sweeping.pop()
+                if parent is not None:
+                    self._sweepStore(parent[0], parent[1], container)
+                continue
+            entry[2] += 1
+            key, value = items[i]
+            if isinstance(value, (DictionaryObject, ArrayObject)):
+                # stored in its parent once everything it contains is swept
+                sweeping.append([value, self._sweepItems(value), 0, (container, key)])
+            else:
+                self._sweepStore(container, key, self._sweepValue(externMap, value, sweeping))
+        return data
+
+    def _sweepItems(self, data):
+        if isinstance(data, DictionaryObject):
+            return list(data.items())
+        return list(enumerate(data))
+
+    def _sweepStore(self, container, key, value):
+        if isinstance(value, StreamObject):
+            # a dictionary or array value is a stream.  streams must be indirect
+            # objects, so we need to change this value.
+            value = self._addObject(value)
+        container[key] = value
+
+    # Returns the swept value; dictionaries and arrays are pushed on the stack and swept in place
+    def _sweepValue(self, externMap, data, sweeping):
         debug = False
         if debug: print((data, "TYPE", data.__class__.__name__))
-        if isinstance(data, DictionaryObject):
-            for key, value in list(data.items()):
-                origvalue = value
-                value = self._sweepIndirectReferences(externMap, value)
-                if isinstance(value, StreamObject):
-                    # a dictionary value is a stream.  streams must be indirect
-                    # objects, so we need to change this value.
-                    value = self._addObject(value)
-                data[key] = value
-            return data
-        elif isinstance(data, ArrayObject):
-            for i in range(len(data)):
-                value = self._sweepIndirectReferences(externMap, data[i])
-                if isinstance(value, StreamObject):
-                    # an array value is a stream.  streams must be indirect
-                    # objects, so we need to change this value
-                    value = self._addObject(value)
-                data[i] = value
+        if isinstance(data, (DictionaryObject, ArrayObject)):
+            sweeping.append([data, self._sweepItems(data), 0, None])
             return data
         elif isinstance(data, IndirectObject):
             # internal indirect references are fine
             if data.pdf == self:
-                if data.idnum in self.stack:
-                    return data
-                else:
-                    self.stack.append(data.idnum)
-                    realdata = self.getObject(data)
-                    self._sweepIndirectReferences(externMap, realdata)
-                    return data
+                if data.idnum not in self.stack:
+                    self.stack.add(data.idnum)
+                    self._sweepValue(externMap, self.getObject(data), sweeping)
+                return data
             else:
-                if data.pdf.stream.closed:
-                    raise ValueError("I/O operation on closed file: {}".format(data.pdf.stream.name))
+                # memory-mapped inputs have no name, nor closed attribute before Python 3.2
+                if getattr(data.pdf.stream, 'closed', False):
+                    raise ValueError("I/O operation on closed file: {}".format(getattr(data.pdf.stream, 'name', data.pdf.stream)))
                 newobj = externMap.get(data.pdf, {}).get(data.generation, {}).get(data.idnum, None)
                 if newobj == None:
                     try:
@@ -585,8 +753,7 @@ class PdfFileWriter(object):
                         if data.generation not in externMap[data.pdf]:
                             externMap[data.pdf][data.generation] = {}
                         externMap[data.pdf][data.generation][data.idnum] = newobj_ido
-                        newobj = self._sweepIndirectReferences(externMap, newobj)
-                        self._objects[idnum-1] = newobj
+                        self._objects[idnum-1] = self._sweepValue(externMap, newobj, sweeping)
                         return newobj_ido
                     except ValueError:
                         # Unable to resolve the Object, returning NullObject instead.
@@ -599,7 +766,10 @@ class PdfFileWriter(object):
             return data
 
     def getReference(self, obj):
-        idnum = self._objects.index(obj) + 1
+        # look the object up by identity first; searching the list compares it with every object before it
+        idnum = self._idnums.get(id(obj))
+        if idnum is None or idnum > len(self._objects) or self._objects[idnum - 1] is not obj:
+            idnum = self._objects.index(obj) + 1
         ref = IndirectObject(idnum, 0, self)
         assert ref.getObject() == obj
         return ref
@@ -607,9 +777,7 @@ class PdfFileWriter(object):
     def getOutlineRoot(self):
         if '/Outlines' in self._root_object:
             outline = self._root_object['/Outlines']
-            idnum = self._objects.index(outline) + 1
-            outlineRef = IndirectObject(idnum, 0, self)
-            assert outlineRef.getObject() == outline
+            outlineRef = self.getReference(outline)
         else:
             outline = TreeObject()
             outline.update({ })
@@ -621,14 +789,10 @@ class PdfFileWriter(object):
     def getNamedDestRoot(self):
         if '/Names' in self._root_object and isinstance(self._root_object['/Names'], DictionaryObject):
             names = self._root_object['/Names']
-            idnum = self._objects.index(names) + 1
-            namesRef = IndirectObject(idnum, 0, self)
-            assert namesRef.getObject() == names
+            namesRef = self.getReference(names)
             if '/Dests' in names and isinstance(names['/Dests'], DictionaryObject):
                 dests = names['/Dests']
-                idnum = self._objects.index(dests) + 1
-                destsRef = IndirectObject(idnum, 0, self)
-                assert destsRef.getObject() == dests
+                destsRef = self.getReference(dests)
                 if '/Names' in dests:
                     nd = dests['/Names']
                 else:
@@ -1046,6 +1210,108 @@ class PdfFileWriter(object):
     and :meth:`setPageMode()<PdfFileWriter.setPageMode>` methods."""
 
 
+class PdfFileStreamWriter(PdfFileWriter):
+    """
+    A :class:`PdfFileWriter<PdfFileWriter>` that writes objects to its
+    output as soon as they are flushed, instead of keeping every object
+    until the whole file is written. After :meth:`flush()<flush>`, the
+    readers that pages were added from can be closed, so memory use and
+    open files do not grow with the number of documents written.
+
+    The page tree, document information and catalog are written last, by
+    :meth:`close()<close>`, so pages, bookmarks and metadata can be added
+    until then.
+
+    :param stream: An object to write the file to.  The object must support
+        the write method and the tell method, similar to a file object.
+    :param bool dedup: as for :class:`PdfFileWriter<PdfFileWriter>`; an
+        object is then also written only once if it is the same as one
+        flushed earlier.
+    """
+    def __init__(self, stream, dedup=False):
+        PdfFileWriter.__init__(self, dedup)
+        if hasattr(stream, 'mode') and 'b' not in stream.mode:
+            warnings.warn("File <%s> to write to is not in binary mode. It may not be written to correctly." % stream.name)
+        self._stream = stream
+        self._object_positions = {}  # object number => offset in the output
+        # the page tree and document information change until the file is closed
+        self._deferred = [self._pages.idnum, self._info.idnum]
+        self._flushed = len(self._objects)
+        stream.write(self._header + b_("\n"))
+
+    def flush(self):
+        """
+        Copies what the objects added since the last flush refer to from
+        other documents, then writes those objects and lets go of them.
+        Objects that are flushed can still be referred to, but no longer
+        changed.
+        """
+        # the deferred objects are swept when the file is closed; each page's /Parent leads to all the pages
+        self._flush(list(range(self._flushed + 1, len(self._objects) + 1)), self._deferred)
+
+    # Sweeps the objects numbered in roots, and the objects they refer to, except those numbered in skip,
+    # then writes the objects added since the last flush and lets go of them
+    def _flush(self, roots, skip):
+        # pages refer to themselves from their own objects, e.g. annotations; see write()
+        externalReferenceMap = {}
+        for idnum in roots:
+            obj = self._objects[idnum - 1]
+            if isinstance(obj, PageObject) and obj.indirectRef != None:
+                data = obj.indirectRef
+                externalReferenceMap.setdefault(data.pdf, {}).setdefault(data.generation, {})[data.idnum] = IndirectObject(idnum, 0, self)
+
+        # objects flushed earlier are None now, so sweeping stops at references to them
+        self.stack = set(skip)
+        for idnum in roots:
+            if idnum not in self.stack:
+                self.stack.add(idnum)
+                self._sweepIndirectReferences(externalReferenceMap, self._objects[idnum - 1])
+        del self.stack
+
+        if self._dedup:
+            self._deduplicate([idnum for idnum in roots if idnum <= self._flushed] + list(range(self._flushed + 1, len(self._objects) + 1)))
+
+        for objIndex in range(self._flushed, len(self._objects)):
+            idnum = objIndex + 1
+            if idnum in self._deferred:
+                continue
+            if idnum in self._duplicates:
+                self._object_positions[idnum] = None
+            else:
+                self._object_positions[idnum] = self._stream.tell()
+                self._writeObject(self._stream, idnum)
+            self._idnums.pop(id(self._objects[objIndex]), None)
+            self._objects[objIndex] = None
+        self._flushed = len(self._objects)
+
+    def write(self, stream):
+        """
+        Finishes the file like :meth:`close()<close>`. Everything flushed so
+        far is already in the stream the writer was created with, so that
+        is the only stream it can be written to.
+
+        :param stream: The stream given to the constructor.
+        :raises ValueError: if ``stream`` is another stream.
+        """
+        if stream is not self._stream:
+            raise ValueError("PdfFileStreamWriter writes to the stream it was created with; use flush() and close()")
+        self.close()
+
+    def close(self):
+        """
+        Writes the objects not flushed yet, the page tree, document
+        information and catalog, and the cross-reference table, which
+        finishes the file. The stream is left open.
+        """
+        if not self._root:
+            self._root = self._addObject(self._root_object)
+        self._flush(self._deferred + list(range(self._flushed + 1, len(self._objects) + 1)), [])
+        for idnum in self._deferred:
+            self._object_positions[idnum] = self._stream.tell()
+            self._writeObject(self._stream, idnum)
+        self._writeTrailer(self._stream, [self._object_positions[idnum] for idnum in range(1, len(self._objects) + 1)])
+
+
 class PdfFileReader(object):
     """
     Initializes a PdfFileReader object.  This operation can take some time, as
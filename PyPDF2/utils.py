@@ -32,6 +32,7 @@ __author__ = "Mathieu Fenniak"
 __author_email__ = "biziqe@mathieu.fenniak.net"
 
 
+import mmap
 import sys
 
 try:
@@ -64,6 +65,19 @@ def isBytes(b):
     return isinstance(b, bytes_type)
 
 
+def mapFile(fileobj):
+    """
+    Maps a file into memory read-only, so a reader can parse it in place and
+    leave stream data in the file until it is used (see StreamSlice).
+    Returns None for files that cannot be mapped, such as empty files,
+    pipes or in-memory streams.
+    """
+    try:
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+
 #custom implementation of warnings.formatwarning
 def formatWarning(message, category, filename, lineno, line=None):
     file = filename.replace("/", "\\").rsplit("\\", 1)[1] # find the file name
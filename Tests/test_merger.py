@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter
+from PyPDF2.merger import PdfFileStreamMerger
+
+
+def makePdf(pages):
+    writer = PdfFileWriter()
+    for i in range(pages):
+        writer.addBlankPage(72, 72)
+    stream = BytesIO()
+    writer.write(stream)
+    stream.seek(0)
+    return stream
+
+
+class AppendManyTestCase(unittest.TestCase):
+
+    def test_appendMany(self):
+        merger = PdfFileMerger()
+        merger.appendMany([makePdf(1), makePdf(2)], bookmarks=["One", "Two"], jobs=2)
+        output = BytesIO()
+        merger.write(output)
+        merger.close()
+        reader = PdfFileReader(output)
+        self.assertEqual(reader.getNumPages(), 3)
+        self.assertEqual([b.title for b in reader.getOutlines()], ["One", "Two"])
+
+    def test_appendMany_bookmark_count(self):
+        for bookmarks in (["One"], ["One", "Two", "Three"]):
+            merger = PdfFileMerger()
+            self.assertRaises(ValueError, merger.appendMany, [makePdf(1), makePdf(1)], bookmarks)
+            self.assertEqual(len(merger.pages), 0)
+            merger.close()
+
+
+class StreamMergerTestCase(unittest.TestCase):
+
+    def test_write_finishes_output(self):
+        output = BytesIO()
+        merger = PdfFileStreamMerger(output)
+        merger.append(makePdf(2))
+        merger.write(output)
+        self.assertEqual(PdfFileReader(output).getNumPages(), 2)
+
+    def test_write_other_output(self):
+        output = BytesIO()
+        merger = PdfFileStreamMerger(output)
+        merger.append(makePdf(1))
+        self.assertRaises(ValueError, merger.write, BytesIO())
+        self.assertRaises(ValueError, merger.output.write, BytesIO())
+        merger.close()
+        self.assertEqual(PdfFileReader(output).getNumPages(), 1)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# Description: times make_book.py and make_ebook.py on synthetic books of several sizes and resolutions
+# Example usage:
+#   python benchmark.py -sz 8,64,512,4096 -dpi 150,300 -of benchmark/results.json
+#   python benchmark.py -sz 8,64 -cmp benchmark/results.json
+#   python benchmark.py -sc "" -mg 1000,10000,100000 -of benchmark/merge.json
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from PIL import Image, ImageDraw
+from PyPDF2 import PdfFileMerger, PdfFileWriter
+from PyPDF2.generic import TextStringObject
+
+# input
+parser = argparse.ArgumentParser()
+parser.add_argument('-sz', dest="SIZES", default="8,64,512,4096", help="Comma-separated list of page counts")
+parser.add_argument('-dpi', dest="DPIS", default="150,300", help="Comma-separated list of page resolutions")
+parser.add_argument('-sc', dest="SCRIPTS", default="make_book,make_ebook", help="Comma-separated list of scripts to run")
+parser.add_argument('-wd', dest="WORK_DIR", default="benchmark/", help="Directory for synthetic pages, manifests and outputs")
+parser.add_argument('-of', dest="OUTPUT_FILE", default="benchmark/results.json", help="File to write results to as JSON")
+parser.add_argument('-cmp', dest="COMPARE_FILE", default="", help="Results of an earlier run to compare against")
+parser.add_argument('-th', dest="THRESHOLD", default=0.1, type=float, help="Fraction by which a run may be slower or larger than the compared run before it counts as a regression")
+parser.add_argument('-rp', dest="REPEAT", default=1, type=int, help="Run each benchmark this many times and keep the fastest")
+parser.add_argument('-py', dest="PYTHON", default=sys.executable, help="Python interpreter to run the scripts with")
+parser.add_argument('-ex', dest="EXTRA_ARGS", default="", help="Extra arguments passed to every script, e.g. \"-j 4\"")
+parser.add_argument('-mg', dest="MERGE_SIZES", default="", help="Comma-separated list of page counts to merge binders of with PdfFileMerger, e.g. 1000,10000,100000")
+
+# init input
+args = parser.parse_args()
+SIZES = [int(s) for s in args.SIZES.split(",")]
+DPIS = [int(d) for d in args.DPIS.split(",")]
+SCRIPTS = [s for s in args.SCRIPTS.split(",") if s]
+MERGE_SIZES = [int(s) for s in args.MERGE_SIZES.split(",") if s]
+WORK_DIR = args.WORK_DIR
+OUTPUT_FILE = args.OUTPUT_FILE
+COMPARE_FILE = args.COMPARE_FILE
+THRESHOLD = args.THRESHOLD
+REPEAT = args.REPEAT
+PYTHON = args.PYTHON
+EXTRA_ARGS = args.EXTRA_ARGS.split()
+
+# config
+pageW = 3.5 # inches, like the pages in pages/
+pageH = 5.5
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+mergePages = 100 # pages per merged binder
+
+# Draws a page with a title and ruled lines, varied per page so every file decodes and compresses like a real one
+def makePage(filename, index, dpi):
+    rand = random.Random(index)
+    (w, h) = (int(round(pageW * dpi)), int(round(pageH * dpi)))
+    image = Image.new("RGB", (w, h), "white")
+    draw = ImageDraw.Draw(image)
+    margin = int(dpi * 0.375)
+    lineH = int(dpi * 0.25)
+    draw.text((margin, margin), "Page %s" % index, fill=(0, 0, 0))
+    y = margin + lineH * 2
+    while y < h - margin:
+        x1 = rand.randint(w / 2, w - margin)
+        draw.line([(margin, y), (x1, y)], fill=(0, 0, 0), width=max(1, dpi / 150))
+        y += lineH
+    del draw
+    image.save(filename, "PNG", dpi=(dpi, dpi))
+
+# Writes pages 0..count-1 at this resolution, keeping the ones made by earlier runs
+def makePages(count, dpi):
+    directory = WORK_DIR + "pages/%s/" % dpi
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    made = 0
+    for i in range(count):
+        filename = directory + "page_%05d.png" % i
+        if not os.path.exists(filename):
+            makePage(filename, i, dpi)
+            made += 1
+    if made > 0:
+        print "Made %s pages at %s DPI" % (made, dpi)
+    return directory
+
+def makeManifest(count, dpi):
+    directory = WORK_DIR + "manifest/"
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    name = "bench_%s_%s" % (count, dpi)
+    with open(directory + name + ".csv", "wb") as f:
+        w = csv.writer(f)
+        w.writerow(["name", "file"])
+        for i in range(count):
+            w.writerow(["Page %s" % i, "page_%05d.png" % i])
+    return (directory, name)
+
+def directoryBytes(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+# Runs a script once from a clean output directory and returns its time, peak memory, output bytes and stages
+def runScript(script, count, dpi, manifestDir, name, inputDir):
+    outputDir = WORK_DIR + "output/%s/" % script
+    if os.path.exists(outputDir):
+        shutil.rmtree(outputDir)
+    timingsFile = WORK_DIR + "timings.json"
+    if os.path.exists(timingsFile):
+        os.remove(timingsFile)
+
+    command = [PYTHON, os.path.join(scriptDir, script + ".py"), "-mf", name, "-md", manifestDir, "-id", inputDir, "-od", outputDir, "-tf", timingsFile] + EXTRA_ARGS
+    with open(WORK_DIR + script + ".log", "w") as log:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        # the peak memory of the script and the workers it waited for
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    if status != 0:
+        print "Warning: %s failed on %s pages at %s DPI, see %s" % (script, count, dpi, WORK_DIR + script + ".log")
+
+    stages = {}
+    if os.path.exists(timingsFile):
+        with open(timingsFile) as f:
+            stages = json.load(f)["stages"]
+    return {
+        "script": script,
+        "pages": count,
+        "dpi": dpi,
+        "status": status,
+        "seconds": seconds,
+        "peakRss": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "outputBytes": directoryBytes(outputDir),
+        "stages": stages
+    }
+
+# Writes a binder of blank pages of different sizes, with bookmarks and named destinations like a real one, for merging
+def makeMergeInput():
+    filename = WORK_DIR + "merge/binder_%s.pdf" % mergePages
+    if os.path.exists(filename):
+        return filename
+    if not os.path.exists(WORK_DIR + "merge/"):
+        os.makedirs(WORK_DIR + "merge/")
+    writer = PdfFileWriter()
+    for i in range(mergePages):
+        writer.addBlankPage(252 + i, 396)
+    for i in range(0, mergePages, 4):
+        writer.addBookmark("Sheet %s" % i, i)
+    for i in range(0, mergePages, 10):
+        writer.addNamedDestination(TextStringObject("page_%s" % i), i)
+    with open(filename, "wb") as f:
+        writer.write(f)
+    return filename
+
+# Merges copies of the binder into one file of this many pages in this process, with a bookmark per copy
+# Times the whole merge, including parsing the copies and writing the result; peak memory is not measured since it includes earlier runs
+def runMerge(count, inputFile):
+    outputFile = WORK_DIR + "merge/merged.pdf"
+    start = time.time()
+    merger = PdfFileMerger()
+    for i in range(0, count, mergePages):
+        merger.append(inputFile, bookmark="Binder %s" % (i / mergePages), pages=(0, min(mergePages, count - i)))
+    merger.write(outputFile)
+    merger.close()
+    seconds = time.time() - start
+    return {
+        "script": "merge",
+        "pages": count,
+        "dpi": None,
+        "status": 0,
+        "seconds": seconds,
+        "peakRss": 0,
+        "outputBytes": os.path.getsize(outputFile),
+        "stages": {}
+    }
+
+def runKey(run):
+    if run["dpi"] is None:
+        return "%s %s pages" % (run["script"], run["pages"])
+    return "%s %s pages %s DPI" % (run["script"], run["pages"], run["dpi"])
+
+# Prints how each run changed since the compared results and returns the number of regressions
+def compare(runs, previousRuns):
+    previous = dict([(runKey(run), run) for run in previousRuns])
+    regressions = 0
+    for run in runs:
+        key = runKey(run)
+        if key not in previous or previous[key]["status"] != 0:
+            continue
+        if run["status"] != 0:
+            print "%s: failed (regression)" % key
+            regressions += 1
+            continue
+        changes = []
+        for field in ["seconds", "peakRss", "outputBytes"]:
+            if previous[key][field] <= 0:
+                continue
+            change = 1.0 * run[field] / previous[key][field] - 1
+            changes.append("%s %+.1f%%" % (field, change * 100))
+            if change > THRESHOLD:
+                changes[-1] += " (regression)"
+                regressions += 1
+        print "%s: %s" % (key, ", ".join(changes))
+    return regressions
+
+# read the compared results first, since they may be overwritten below
+previousRuns = []
+if COMPARE_FILE:
+    with open(COMPARE_FILE) as f:
+        previousRuns = json.load(f)["runs"]
+
+runs = []
+for dpi in (DPIS if len(SCRIPTS) else []):
+    inputDir = makePages(max(SIZES), dpi)
+    for count in SIZES:
+        (manifestDir, name) = makeManifest(count, dpi)
+        for script in SCRIPTS:
+            best = None
+            for r in range(REPEAT):
+                run = runScript(script, count, dpi, manifestDir, name, inputDir)
+                if best is None or run["seconds"] < best["seconds"]:
+                    best = run
+            runs.append(best)
+            print "%s: %.2fs, %sMB peak, %sMB output" % (runKey(best), best["seconds"], round(best["peakRss"] / 1048576.0, 1), round(best["outputBytes"] / 1048576.0, 1))
+
+# merging should take about the same time per page at every size
+if len(MERGE_SIZES):
+    inputFile = makeMergeInput()
+    for count in MERGE_SIZES:
+        best = None
+        for r in range(REPEAT):
+            run = runMerge(count, inputFile)
+            if best is None or run["seconds"] < best["seconds"]:
+                best = run
+        runs.append(best)
+        print "%s: %.2fs, %.3fs per 1000 pages, %sMB output" % (runKey(best), best["seconds"], best["seconds"] * 1000.0 / count, round(best["outputBytes"] / 1048576.0, 1))
+
+results = {
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "python": PYTHON,
+    "platform": platform.platform(),
+    "extraArgs": EXTRA_ARGS,
+    "runs": runs
+}
+outputDir = os.path.dirname(OUTPUT_FILE)
+if outputDir and not os.path.exists(outputDir):
+    os.makedirs(outputDir)
+with open(OUTPUT_FILE, "w") as f:
+    json.dump(results, f, indent=2)
+print "Saved results: %s" % OUTPUT_FILE
+
+if COMPARE_FILE:
+    regressions = compare(runs, previousRuns)
+    if regressions > 0:
+        print "%s regressions" % regressions
+        sys.exit(1)
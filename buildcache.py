@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Description: remembers what each output file was built from so unchanged outputs can be skipped
+
+import hashlib
+import json
+import os
+
+# content digests of source files, keyed by path, modification time and size so each file is read at most once per run
+fileDigests = {}
+
+def fileDigest(filename):
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    if key not in fileDigests:
+        h = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        fileDigests[key] = h.hexdigest()
+    return fileDigests[key]
+
+# Digest of any value that can be written as JSON
+def digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+class BuildCache(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.digests = {} # output file name => digest of everything it was built from
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.digests = json.load(f)
+            except ValueError:
+                print "Warning: ignoring unreadable build cache %s" % filename
+
+    def isFresh(self, outputFile, value):
+        return self.digests.get(os.path.basename(outputFile)) == value and os.path.exists(outputFile)
+
+    def update(self, outputFile, value):
+        self.digests[os.path.basename(outputFile)] = value
+
+    def save(self):
+        # write next to the cache and rename so an interrupted run never leaves a partial cache
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.digests, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.filename)
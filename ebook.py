@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Description: lays out a manifest as an ebook: the front and back covers on their own and the inner pages as two-page spreads
+# Used by make_ebook.py, and by make_book.py to build the ebook from the same pages and caches as the print run
+
+import os
+from imposition import Binder
+from stagetimer import timer
+
+# Returns the ebook's PDF pages as (file, [page files]) and its binders as (file, [PDF page files])
+def planEbook(pages, directory, fileExt=".pdf"):
+    frontCover = pages[0]["file"]
+    backCover = pages[-1]["file"]
+    innerPages = [page["file"] for page in pages[1:-1]]
+
+    frontFile = directory + "/cover_front" + fileExt
+    backFile = directory + "/cover_back" + fileExt
+    combinedCoverFile = directory + "/spread_covers" + fileExt
+    files = [(frontFile, [frontCover]), (backFile, [backCover]), (combinedCoverFile, [backCover, frontCover])]
+    spreadFiles = []
+    for i in range(0, len(innerPages), 2):
+        outputFile = directory + "/spread_" + format(int(i/2), '03') + fileExt
+        files.append((outputFile, innerPages[i:i+2]))
+        spreadFiles.append(outputFile)
+
+    return {
+        "files": files,
+        "binders": [
+            (directory + "/binder" + fileExt, [frontFile] + spreadFiles + [backFile]),
+            (directory + "/binder_combined_covers" + fileExt, [combinedCoverFile] + spreadFiles)
+        ]
+    }
+
+# Page files in the order writeEbook encodes them
+def ebookPageFiles(plan):
+    pageFiles = []
+    for outputFile, filePaths in plan["files"]:
+        pageFiles += filePaths
+    return pageFiles
+
+def bindPages(pages, filename):
+    with timer.stage("merge"):
+        binder = Binder(filename)
+        for page, images in pages:
+            binder.addSheet(page, images)
+        binder.close()
+    timer.addBytes("merge", os.path.getsize(filename))
+
+# Writes every PDF page of the plan with its pages side by side, then the binders from the same in-memory pages
+# encodedPage(file) returns a page as an encoded image or PDF page (see imposition.py)
+def writeEbook(plan, pageSize, resolution, encodedPage):
+    (pageW, pageH) = pageSize
+    written = {}
+    for outputFile, filePaths in plan["files"]:
+        page = {
+            "size": (pageW * len(filePaths), pageH),
+            "resolution": resolution,
+            "placements": [(filePath, i * pageW, 0) for i, filePath in enumerate(filePaths)],
+            "guides": []
+        }
+        images = dict([(filePath, encodedPage(filePath)) for filePath in filePaths])
+        bindPages([(page, images)], outputFile)
+        written[outputFile] = (page, images)
+        print "Saved image: %s" % outputFile
+
+    for binderFile, outputFiles in plan["binders"]:
+        bindPages([written[outputFile] for outputFile in outputFiles], binderFile)
+        print "Saved binder: %s" % binderFile
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+# Description: size-bounded LRU cache of decoded page images, shared by every sheet in a run
+# Images are keyed by path plus modification time and size so an edited file is decoded again
+# Cached images are shared; callers must not modify them in place
+# The cache is thread safe; a file requested while another thread decodes it waits for that decode
+# Decoded images can also be kept on disk between runs as raw pixel buffers, see DiskCache
+
+from collections import OrderedDict
+import json
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+from PIL import Image
+from buildcache import fileDigest
+from stagetimer import timer
+
+# The size of an image with the given DPI when shown at another resolution
+def scaledSize(size, dpi, resolution):
+    scale = 1.0 * resolution / dpi
+    return (int(round(size[0] * scale)), int(round(size[1] * scale)))
+
+# The number of bytes PIL holds in memory for a decoded image: one per pixel for 1, L and P, two for 16 bit modes, otherwise four, since PIL pads RGB pixels to four bytes
+def imageBytes(image):
+    (w, h) = image.size
+    if image.mode in ("1", "L", "P"):
+        return w * h
+    if image.mode.startswith("I;16"):
+        return w * h * 2
+    return w * h * 4
+
+# Keeps decoded pages on disk as raw pixel buffers with their mode, size, DPI and palette, keyed by the content of the source file
+# Reading a page back maps the buffer into memory instead of inflating the PNG again
+# Least recently used pages are deleted when the directory grows past maxBytes
+class DiskCache(object):
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.bytes = sum([os.path.getsize(path) for path in self.files()])
+        self.evict()
+
+    def files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".raw")]
+
+    def path(self, filename, resolution):
+        return os.path.join(self.directory, "%s_%s" % (fileDigest(filename), resolution or "full"))
+
+    # The mode, size, DPI and palette of a cached page, or None if it is not cached
+    def meta(self, path):
+        try:
+            with open(path + ".json") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get(self, filename, resolution=None):
+        path = self.path(filename, resolution)
+        meta = self.meta(path)
+        if meta is None:
+            return None
+        try:
+            with open(path + ".raw", "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # modes PIL can map (L, P, RGBA, CMYK) use the buffer in place, others are unpacked from it
+        image = Image.frombuffer(meta["mode"], tuple(meta["size"]), buf, "raw", meta["mode"], 0, 1)
+        if meta["dpi"] is not None:
+            image.info["dpi"] = tuple(meta["dpi"])
+        # palette pages keep their palette and transparent color or alpha per palette entry
+        if meta.get("palette") is not None:
+            image.putpalette(meta["palette"])
+        if meta.get("transparency") is not None:
+            transparency = meta["transparency"]
+            if isinstance(transparency, list):
+                transparency = bytes(bytearray(transparency)) if meta["mode"] in ("P", "PA") else tuple(transparency)
+            image.info["transparency"] = transparency
+        # mark the page as recently used
+        try:
+            os.utime(path + ".raw", None)
+        except OSError:
+            pass
+        return image
+
+    # Opens a cached page for reading a few rows at a time, or returns None if the page is not cached
+    # Pages cached in a mode RowReader cannot read, e.g. P pages cached by a run without bands, count as not cached
+    def openRows(self, filename, resolution=None):
+        path = self.path(filename, resolution)
+        meta = self.meta(path)
+        if meta is None or meta["mode"] not in rowModes:
+            return None
+        try:
+            rows = RowReader(path + ".raw", meta["mode"], tuple(meta["size"]))
+        except (IOError, OSError, KeyError):
+            return None
+        try:
+            os.utime(path + ".raw", None)
+        except OSError:
+            pass
+        return rows
+
+    # With replace, a page already cached, e.g. in a mode RowReader cannot read, is written again
+    def put(self, filename, image, resolution=None, replace=False):
+        path = self.path(filename, resolution)
+        if not replace and self.meta(path) is not None:
+            return
+        # write under a temporary name and rename, so other processes never read a partial page
+        tmp = "%s.%s.%s.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        data = image.tobytes()
+        with open(tmp, "wb") as f:
+            f.write(data)
+        replaced = os.path.getsize(path + ".raw") if replace and os.path.exists(path + ".raw") else 0
+        os.rename(tmp, path + ".raw")
+        palette = image.getpalette() if image.mode in ("P", "PA") else None
+        transparency = image.info.get("transparency")
+        if isinstance(transparency, bytes):
+            transparency = list(bytearray(transparency))
+        with open(tmp, "w") as f:
+            json.dump({"mode": image.mode, "size": image.size, "dpi": image.info.get("dpi"), "palette": palette, "transparency": transparency}, f)
+        os.rename(tmp, path + ".json")
+        with self.lock:
+            self.bytes += len(data) - replaced
+        if self.bytes > self.maxBytes:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            if self.bytes <= self.maxBytes:
+                return
+            files = self.files()
+            files.sort(key=lambda path: os.path.getmtime(path))
+            self.bytes = sum([os.path.getsize(path) for path in files])
+            for path in files:
+                if self.bytes <= self.maxBytes:
+                    break
+                # pages mapped by a running process stay readable after they are deleted
+                size = os.path.getsize(path)
+                for name in [path[:-len(".raw")] + ".json", path]:
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        pass
+                self.bytes -= size
+
+# bytes per pixel of the raw buffers of the modes RowReader reads; "1" packs 8 pixels per byte
+rowModes = {"1": None, "L": 1, "RGB": 3, "RGBA": 4}
+
+def rowBytes(mode, w):
+    if mode == "1":
+        return (w + 7) // 8
+    return w * rowModes[mode]
+
+# Reads rows of a page kept by DiskCache from its raw buffer, so only those rows are ever in memory
+class RowReader(object):
+
+    def __init__(self, path, mode, size):
+        self.mode = mode
+        self.size = size
+        self.stride = rowBytes(mode, size[0])
+        self.file = open(path, "rb")
+
+    # Returns rows y0 to y1 as an image
+    def read(self, y0, y1):
+        self.file.seek(y0 * self.stride)
+        data = self.file.read((y1 - y0) * self.stride)
+        return Image.frombytes(self.mode, (self.size[0], y1 - y0), data)
+
+    def close(self):
+        self.file.close()
+
+class ImageCache(object):
+
+    # With a resolution, images are decoded at that many pixels per inch instead of their own DPI, e.g. for proofs
+    # With a disk cache, pages decoded by earlier runs are read back from it
+    def __init__(self, maxBytes, resolution=None, diskCache=None):
+        self.maxBytes = maxBytes
+        self.resolution = resolution
+        self.diskCache = diskCache
+        self.images = OrderedDict() # key => image, least recently used first
+        self.keys = {} # path => key of the cached version of that file
+        self.loading = {} # key => event and result of a decode in progress
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.diskHits = 0
+        self.uses = None # path => requests the plan still has for it, see plan()
+
+    # Plans the requests of a build, so pages requested only once are not kept after that request and others are dropped after their last one
+    # Prefetched pages are kept until they are requested; without a plan every page is kept as long as the budget allows
+    def plan(self, filenames):
+        uses = {}
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            uses[path] = uses.get(path, 0) + 1
+        with self.lock:
+            self.uses = uses
+
+    # Counts a request against the plan and drops the image after its last planned request
+    def used(self, key):
+        if self.uses is None or key[0] not in self.uses:
+            return
+        self.uses[key[0]] -= 1
+        if self.uses[key[0]] <= 0:
+            del self.uses[key[0]]
+            if key in self.images:
+                self.remove(key)
+
+    def key(self, filename):
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_mtime, stat.st_size, self.resolution)
+
+    # Prefetching requests only count as misses when they decode, so hits are the requests served without decoding
+    def get(self, filename, prefetch=False):
+        key = self.key(filename)
+        with self.lock:
+            if key in self.images:
+                image = self.images.pop(key)
+                self.images[key] = image
+                if not prefetch:
+                    self.hits += 1
+                    self.used(key)
+                return image
+            loading = self.loading.get(key)
+            if loading is None:
+                self.misses += 1
+                loading = self.loading[key] = {"event": threading.Event(), "image": None, "error": None}
+                isLoader = True
+            else:
+                if not prefetch:
+                    self.hits += 1
+                isLoader = False
+
+        if not isLoader:
+            loading["event"].wait()
+            if loading["error"] is not None:
+                raise loading["error"]
+            if not prefetch:
+                with self.lock:
+                    self.used(key)
+            return loading["image"]
+
+        try:
+            with timer.stage("decode"):
+                loading["image"] = self.load(filename)
+        except Exception as e:
+            loading["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.loading[key]
+                if loading["image"] is not None:
+                    self.add(key, loading["image"])
+                    if not prefetch:
+                        self.used(key)
+            loading["event"].set()
+        return loading["image"]
+
+    def load(self, filename):
+        if self.diskCache is not None:
+            image = self.diskCache.get(filename, self.resolution)
+            if image is None:
+                image = self.decode(filename)
+                self.diskCache.put(filename, image, self.resolution)
+            else:
+                with self.lock:
+                    self.diskHits += 1
+            return image
+        return self.decode(filename)
+
+    def decode(self, filename):
+        image = Image.open(filename)
+        if not self.resolution or 'dpi' not in image.info:
+            image.load()
+            return image
+
+        dpi = image.info['dpi'][0]
+        size = scaledSize(image.size, dpi, self.resolution)
+        if size[0] >= image.size[0]:
+            image.load()
+            return image
+
+        # formats that support it (JPEG) decode at a fraction of their size
+        image.draft(image.mode, size)
+        image.load()
+        if image.size != size:
+            factor = image.size[0] // size[0]
+            if hasattr(image, "reduce") and factor > 1 and image.size[0] == size[0] * factor and image.size[1] == size[1] * factor:
+                image = image.reduce(factor)
+            else:
+                image = image.resize(size, Image.BOX)
+        image.info['dpi'] = (self.resolution, self.resolution)
+        return image
+
+    def add(self, key, image):
+        # drop an older version of the same file
+        path = key[0]
+        if path in self.keys and self.keys[path] in self.images:
+            self.remove(self.keys[path])
+
+        size = imageBytes(image)
+        if size <= self.maxBytes:
+            self.images[key] = image
+            self.keys[path] = key
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                oldest = next(iter(self.images))
+                self.remove(oldest)
+                self.evictions += 1
+
+    def remove(self, key):
+        image = self.images.pop(key)
+        self.bytes -= imageBytes(image)
+        if self.keys.get(key[0]) == key:
+            del self.keys[key[0]]
+
+    # hits, misses, evictions and misses read from disk so far; workers report theirs back so the summary covers the whole run
+    def counters(self):
+        with self.lock:
+            return (self.hits, self.misses, self.evictions, self.diskHits)
+
+    def addCounters(self, counters):
+        (hits, misses, evictions, diskHits) = counters
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+            self.diskHits += diskHits
+
+    def summary(self):
+        misses = "%s misses" % self.misses
+        if self.diskCache is not None:
+            misses += " (%s read from disk)" % self.diskHits
+        return "%s hits, %s, %s evictions, %sMB cached" % (self.hits, misses, self.evictions, round(self.bytes / 1048576.0, 1))
+
+# Decodes upcoming page images into a cache on background threads, so reading and inflating them overlaps with compositing and encoding
+# Pages must be requested through get() in the order of filenames; at most depth files are read ahead of the current one
+class Prefetcher(object):
+
+    def __init__(self, cache, filenames, depth, threads=4):
+        self.cache = cache
+        self.filenames = filenames
+        self.depth = depth
+        self.position = 0 # index of the next file that will be requested
+        self.requested = 0 # files before this index were handed to the threads
+        self.pool = ThreadPool(threads)
+
+    def get(self, filename):
+        try:
+            self.position = self.filenames.index(filename, self.position) + 1
+        except ValueError:
+            pass
+        self.requested = max(self.requested, self.position)
+        while self.requested < min(len(self.filenames), self.position + self.depth):
+            # errors are left for get() to raise when the file is actually needed
+            self.pool.apply_async(self.prefetch, (self.filenames[self.requested],))
+            self.requested += 1
+        return self.cache.get(filename)
+
+    def prefetch(self, filename):
+        try:
+            self.cache.get(filename, prefetch=True)
+        except Exception:
+            pass
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
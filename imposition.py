@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+# Description: builds imposed sheets directly as PDF pages, placing page images as shared image XObjects
+# A sheet is a dict with:
+#   "size": (w, h) in pixels
+#   "resolution": pixels per inch used to convert pixels to PDF points
+#   "placements": list of (key, x, y) where key refers to an encoded image or PDF page and (x, y) is its top-left pixel
+#   "guides": list of [(x0, y0), (x1, y1)] guide lines in pixels
+
+from io import BytesIO
+import struct
+import zlib
+from PIL import Image, ImageChops
+from PyPDF2 import PdfFileReader, PdfFileStreamWriter
+from PyPDF2.pdf import PageObject
+from PyPDF2.utils import mapFile
+from PyPDF2.generic import ArrayObject, ByteStringObject, DictionaryObject, EncodedStreamObject, DecodedStreamObject, FloatObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+# Guides are drawn with PIL's fill=128 on RGB sheets, which is (128, 0, 0)
+GUIDE_COLOR = (128.0/255, 0, 0)
+
+# Sheet modes from smallest to largest
+MODES = ["1", "L", "RGB"]
+
+# Returns the smallest mode that shows the image without visible loss: "1" for black and white, "L" for grayscale, otherwise "RGB"
+# Channels that differ by at most tolerance still count as gray, since exported pages rarely have exactly equal channels
+def simplestMode(image, tolerance=0):
+    if image.mode == "1":
+        return "1"
+    if image.mode != "L":
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        (r, g, b) = image.split()
+        for a, b in [(r, g), (g, b), (r, b)]:
+            if ImageChops.difference(a, b).getextrema()[1] > tolerance:
+                return "RGB"
+        image = image.convert("L")
+    histogram = image.histogram()
+    if sum(histogram[1:255]) == 0:
+        return "1"
+    return "L"
+
+# Returns the image in the given mode; black and white images are thresholded, not dithered
+def convertImage(image, mode):
+    if image.mode == mode:
+        return image
+    if mode == "1":
+        if image.mode != "L":
+            image = image.convert("L")
+        return image.convert("1", dither=Image.NONE)
+    return image.convert(mode)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Yields the (type, data) chunks of a PNG file's contents
+def pngChunks(png):
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(png):
+        (length, chunkType) = struct.unpack(">I4s", png[offset:offset+8])
+        yield (chunkType, png[offset+8:offset+8+length])
+        offset += length + 12
+
+# The compressed rows of a PNG, which are exactly a Flate stream with PNG predictors
+def pngData(image):
+    buf = BytesIO()
+    image.save(buf, "PNG")
+    return b"".join([data for chunkType, data in pngChunks(buf.getvalue()) if chunkType == b"IDAT"])
+
+# Encodes a PNG file by embedding its compressed rows as they are, without decoding it
+# Returns None for PNGs a PDF can't show this way: interlaced, with alpha or transparency, or 16 bits per channel
+def readPng(filename):
+    with open(filename, "rb") as f:
+        png = f.read()
+    if png[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        return None
+
+    header = None
+    palette = None
+    data = []
+    for chunkType, chunk in pngChunks(png):
+        if chunkType == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif chunkType == b"PLTE":
+            palette = chunk
+        elif chunkType == b"IDAT":
+            data.append(chunk)
+        elif chunkType == b"tRNS":
+            return None
+    if header is None:
+        return None
+    (w, h, bitsPerComponent, colorType, compression, filterMethod, interlace) = header
+    # color types: 0 gray, 2 RGB, 3 palette; 4 and 6 have alpha
+    if interlace != 0 or bitsPerComponent > 8 or colorType not in (0, 2, 3) or (colorType == 3 and palette is None):
+        return None
+
+    # palette images index into RGB colors
+    colors = 1
+    colorSpace = "/DeviceGray"
+    if colorType != 0:
+        colorSpace = "/DeviceRGB"
+    if colorType == 2:
+        colors = 3
+    image = {
+        "size": (w, h),
+        "colorSpace": colorSpace,
+        "bitsPerComponent": bitsPerComponent,
+        "filter": "/FlateDecode",
+        "decodeParms": {"/Predictor": 15, "/Colors": colors, "/BitsPerComponent": bitsPerComponent, "/Columns": w},
+        "data": b"".join(data)
+    }
+    if colorType == 3:
+        image["palette"] = palette
+    return image
+
+# Encodes a PIL image once so it can be embedded in any number of PDFs
+def encodeImage(image):
+    # Black and white and grayscale images are stored losslessly, everything else as JPEG like PIL's own PDF writer
+    if image.mode in ("1", "L"):
+        bitsPerComponent = 8
+        if image.mode == "1":
+            bitsPerComponent = 1
+        return {
+            "size": image.size,
+            "colorSpace": "/DeviceGray",
+            "bitsPerComponent": bitsPerComponent,
+            "filter": "/FlateDecode",
+            "decodeParms": {"/Predictor": 15, "/Colors": 1, "/BitsPerComponent": bitsPerComponent, "/Columns": image.size[0]},
+            "data": pngData(image)
+        }
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buf = BytesIO()
+    image.save(buf, "JPEG")
+    return {
+        "size": image.size,
+        "colorSpace": "/DeviceRGB",
+        "bitsPerComponent": 8,
+        "filter": "/DCTDecode",
+        "data": buf.getvalue()
+    }
+
+# Encodes an image handed over in horizontal bands, top to bottom, as one Flate stream, so the whole image is never in memory at once
+# Bands must be in mode "1", "L" or "RGB" and as wide as the image; rows are stored without predictors, and RGB is lossless rather than JPEG
+class BandEncoder(object):
+
+    def __init__(self, mode, size):
+        self.mode = mode
+        self.size = size
+        self.compressor = zlib.compressobj()
+        self.chunks = []
+        self.bytes = 0
+
+    def add(self, band):
+        chunk = self.compressor.compress(band.tobytes())
+        self.chunks.append(chunk)
+        self.bytes += len(chunk)
+
+    def finish(self):
+        self.chunks.append(self.compressor.flush())
+        colorSpace = "/DeviceGray"
+        bitsPerComponent = 8
+        if self.mode == "1":
+            bitsPerComponent = 1
+        elif self.mode == "RGB":
+            colorSpace = "/DeviceRGB"
+        return {
+            "size": self.size,
+            "colorSpace": colorSpace,
+            "bitsPerComponent": bitsPerComponent,
+            "filter": "/FlateDecode",
+            "data": b"".join(self.chunks)
+        }
+
+def isPdf(filename):
+    return filename.lower().endswith(".pdf")
+
+# Opens the first page of a PDF so it can be placed as a Form XObject without rasterizing it
+# Everything the page uses is read up front and the file is closed, so open files do not grow with the number of PDF pages
+def openPdfPage(filename):
+    f = open(filename, "rb")
+    try:
+        reader = PdfFileReader(f)
+        page = reader.getPage(0)
+        if page.get("/Rotate", 0) % 360 != 0:
+            print "Warning: ignoring /Rotate of %s" % filename
+
+        contents = page.getContents()
+        if contents is None:
+            data = b""
+        elif isinstance(contents, ArrayObject):
+            data = b"\n".join([c.getObject().getData() for c in contents])
+        else:
+            data = contents.getData()
+
+        box = page.cropBox
+        resources = page.get("/Resources", DictionaryObject())
+        resolveObjects(resources, reader, set())
+    finally:
+        f.close()
+    return {
+        "reader": reader,
+        "box": tuple([float(v) for v in box]),
+        "resources": resources,
+        "data": data
+    }
+
+# Reads every object an object refers to into the reader's cache, so binders can import it after the reader's file is closed
+def resolveObjects(obj, reader, seen):
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key not in seen:
+            seen.add(key)
+            resolveObjects(reader.getObject(obj), reader, seen)
+    elif isinstance(obj, DictionaryObject):
+        for v in obj.values():
+            resolveObjects(v, reader, seen)
+    elif isinstance(obj, ArrayObject):
+        for v in obj:
+            resolveObjects(v, reader, seen)
+
+# Returns the size of an encoded image or PDF page in pixels at the given resolution
+def placementSize(image, resolution):
+    if "box" in image:
+        (llx, lly, urx, ury) = image["box"]
+        return (int(round((urx - llx) * resolution / 72.0)), int(round((ury - lly) * resolution / 72.0)))
+    return image["size"]
+
+def formatNumber(n):
+    s = "%.3f" % n
+    s = s.rstrip("0").rstrip(".")
+    if s == "-0":
+        s = "0"
+    return s
+
+# Collects sheets into one PDF, embedding each unique image once no matter how many sheets use it
+# Each sheet is written to the file as soon as it is added, so memory use and open files do not grow with the number of sheets; close() finishes the file
+# Sheets added from saved PDFs each bring their own copy of their images, so objects are also deduplicated by content as they are written
+class Binder(object):
+
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.writer = PdfFileStreamWriter(self.file, dedup=True)
+        self.xobjects = {}
+        self.imported = {} # id of a reader => {(object number, generation) => reference}
+
+    # Copies an object from a reader into this binder's PDF; unlike PdfFileWriter's own sweep this leaves the reader untouched so it can feed several binders
+    def importObject(self, obj, reader):
+        if isinstance(obj, IndirectObject):
+            imported = self.imported.setdefault(id(reader), {})
+            key = (obj.idnum, obj.generation)
+            if key not in imported:
+                # reserve the number first so cyclic references resolve to it
+                self.writer._objects.append(None)
+                ref = IndirectObject(len(self.writer._objects), 0, self.writer)
+                imported[key] = ref
+                self.writer._objects[ref.idnum - 1] = self.importObject(reader.getObject(obj), reader)
+            return imported[key]
+        elif isinstance(obj, StreamObject):
+            clone = obj.__class__()
+            # the raw data may be a slice of a mapped sheet PDF, which is then only read while the binder is written
+            clone._rawData = obj._rawData
+            for k, v in list(obj.items()):
+                clone[k] = self.importObject(v, reader)
+            return clone
+        elif isinstance(obj, DictionaryObject):
+            clone = DictionaryObject()
+            for k, v in list(obj.items()):
+                clone[k] = self.importObject(v, reader)
+            return clone
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject([self.importObject(v, reader) for v in obj])
+        return obj
+
+    def getXObject(self, key, images):
+        if key in self.xobjects:
+            return self.xobjects[key]
+
+        image = images[key]
+        if "box" in image:
+            stream = DecodedStreamObject()
+            stream.setData(image["data"])
+            stream = stream.flateEncode()
+            stream.update({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): ArrayObject([FloatObject(v) for v in image["box"]]),
+                NameObject("/Resources"): self.importObject(image["resources"], image["reader"])
+            })
+            name = "/Fm%s" % len(self.xobjects)
+        else:
+            (w, h) = image["size"]
+            stream = EncodedStreamObject()
+            stream._data = image["data"]
+            stream.update({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Image"),
+                NameObject("/Width"): NumberObject(w),
+                NameObject("/Height"): NumberObject(h),
+                NameObject("/ColorSpace"): NameObject(image["colorSpace"]),
+                NameObject("/BitsPerComponent"): NumberObject(image["bitsPerComponent"]),
+                NameObject("/Filter"): NameObject(image["filter"])
+            })
+            if "palette" in image:
+                stream[NameObject("/ColorSpace")] = ArrayObject([NameObject("/Indexed"), NameObject("/DeviceRGB"), NumberObject(len(image["palette"]) // 3 - 1), ByteStringObject(image["palette"])])
+            if "decodeParms" in image:
+                stream[NameObject("/DecodeParms")] = DictionaryObject(dict([(NameObject(k), NumberObject(v)) for k, v in image["decodeParms"].items()]))
+            name = "/Im%s" % len(self.xobjects)
+        self.xobjects[key] = (NameObject(name), self.writer._addObject(stream))
+        return self.xobjects[key]
+
+    def addSheet(self, sheet, images):
+        (sheetW, sheetH) = sheet["size"]
+        scale = 72.0 / sheet["resolution"]
+        page = self.writer.addBlankPage(sheetW * scale, sheetH * scale)
+
+        resources = DictionaryObject()
+        content = []
+        for key, x, y in sheet["placements"]:
+            name, ref = self.getXObject(key, images)
+            resources[name] = ref
+            (w, h) = placementSize(images[key], sheet["resolution"])
+            # PDF coordinates start from the bottom-left corner
+            if "box" in images[key]:
+                # forms are drawn in their own point units, so only move their box into place
+                (llx, lly, urx, ury) = images[key]["box"]
+                content.append("q 1 0 0 1 %s %s cm %s Do Q" % (formatNumber(x * scale - llx), formatNumber((sheetH - y - h) * scale - lly), name))
+            else:
+                content.append("q %s 0 0 %s %s %s cm %s Do Q" % (formatNumber(w * scale), formatNumber(h * scale), formatNumber(x * scale), formatNumber((sheetH - y - h) * scale), name))
+
+        if len(sheet["guides"]):
+            # Guides are one pixel wide; square caps make them cover the same pixels PIL would draw
+            content.append("q %s %s %s RG %s w 2 J" % (formatNumber(GUIDE_COLOR[0]), formatNumber(GUIDE_COLOR[1]), formatNumber(GUIDE_COLOR[2]), formatNumber(scale)))
+            for (x0, y0), (x1, y1) in sheet["guides"]:
+                content.append("%s %s m %s %s l S" % (formatNumber((x0 + 0.5) * scale), formatNumber((sheetH - y0 - 0.5) * scale), formatNumber((x1 + 0.5) * scale), formatNumber((sheetH - y1 - 0.5) * scale)))
+            content.append("Q")
+
+        contents = DecodedStreamObject()
+        contents.setData("\n".join(content).encode("latin-1"))
+        page[NameObject("/Contents")] = self.writer._addObject(contents.flateEncode())
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/ProcSet"): ArrayObject([NameObject("/PDF"), NameObject("/ImageB"), NameObject("/ImageC")]),
+            NameObject("/XObject"): resources
+        })
+        self.writer.flush()
+
+    # Adds the first page of an existing PDF, e.g. a sheet saved by an earlier run
+    # The file is memory-mapped where possible, so its images are copied straight from it to the binder rather than read into memory
+    def addPdfPage(self, filename):
+        f = open(filename, "rb")
+        mapped = mapFile(f)
+        if mapped is not None:
+            f.close()
+            f = mapped
+        reader = PdfFileReader(f)
+        page = reader.getPage(0)
+        clone = PageObject(self.writer)
+        for k, v in list(page.items()):
+            if k != "/Parent":
+                clone[NameObject(k)] = self.importObject(v, reader)
+        self.writer.addPage(clone)
+        self.writer.flush()
+        f.close()
+        # another reader may get the same id once this one is gone
+        self.imported.pop(id(reader), None)
+
+    def close(self):
+        self.writer.close()
+        self.file.close()
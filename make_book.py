@@ -5,12 +5,24 @@
 #   python make_book.py -mf red,yellow,blue
 
 import argparse
+import cProfile
 import csv
 import math
+import multiprocessing
 import os
+import shutil
+import tempfile
 from PIL import Image, ImageDraw
-from PyPDF2 import PdfFileMerger
+import time
+from buildcache import BuildCache, digest, fileDigest
+from ebook import ebookPageFiles, planEbook, writeEbook
+from imagecache import DiskCache, ImageCache, Prefetcher, rowModes, scaledSize
+from imposition import GUIDE_COLOR, MODES, BandEncoder, Binder, convertImage, encodeImage, isPdf, openPdfPage, readPng, simplestMode
+from pageprobe import checkPages, probePages
+from stagetimer import Trace, timer
 import sys
+import traceback
+from watch import Watcher
 
 # input
 parser = argparse.ArgumentParser()
@@ -19,10 +31,29 @@ parser.add_argument('-mf', dest="INPUT_MANIFEST_FILES", default="red,yellow,blue
 parser.add_argument('-md', dest="MANIFEST_DIR", default="manifest/", help="Directory of manifest files")
 parser.add_argument('-id', dest="INPUT_DIR", default="pages/", help="Directory of input files/pages")
 parser.add_argument('-od', dest="OUTPUT_DIR", default="print/", help="Directory for output files")
+parser.add_argument('-eb', dest="EBOOK_DIR", default="", help="Also build the ebook into this directory (e.g. ebook/), reusing the pages loaded for print")
 parser.add_argument('-g', dest="GUIDES", default=True, type=bool, help="Show or hide guides")
 parser.add_argument('-cg', dest="COVER_GUTTER", default=0.25, type=float, help="Cover gutter in inches")
 parser.add_argument('-pg', dest="PAGE_GUTTER", default=0.125, type=float, help="Page gutter in inches")
 parser.add_argument('-pgi', dest="PAGE_GUTTER_INCREMENT", default=0.0, type=float, help="Page gutter increment in inches")
+parser.add_argument('-sg', dest="SIGNATURE_SHEETS", default=0, type=int, help="Nest the pages inside the covers in signatures of this many sheets each instead of one stack for the whole book; 0 nests the whole book")
+parser.add_argument('-pr', '--proof', dest="PROOF", default=0, type=int, help="Render low resolution proofs at this DPI")
+parser.add_argument('-cs', dest="CACHE_SIZE", default=64, type=int, help="Memory budget for decoded page images in megabytes, split between the processes of -j; only pages used again later and pages read ahead are kept")
+parser.add_argument('-dc', dest="DISK_CACHE_DIR", default="", help="Directory to keep decoded page images in between runs; off by default")
+parser.add_argument('-bm', dest="BAND_MEMORY", default=0, type=int, help="Composite each raster sheet in horizontal bands using about this many megabytes, reading pages back from the disk cache a few rows at a time; 0 composites whole sheets")
+parser.add_argument('-dcs', dest="DISK_CACHE_SIZE", default=4096, type=int, help="Disk budget for decoded page images in megabytes")
+parser.add_argument('-pf', dest="PREFETCH", default=8, type=int, help="Number of upcoming page images to decode in the background when rendering without worker processes; 0 turns read-ahead off")
+parser.add_argument('-fr', '--force', dest="FORCE", action="store_true", help="Rebuild every sheet and binder even if its inputs did not change")
+parser.add_argument('-ns', '--no-sheet-files', dest="SHEET_FILES", action="store_false", help="Only write the binders, not a PDF per sheet")
+parser.add_argument('-j', '--jobs', dest="JOBS", default=1, type=int, help="Number of processes rendering sheets in parallel")
+parser.add_argument('-im', dest="IMPOSITION", default="raster", choices=["raster", "vector"], help="Imposition mode: raster composites each sheet into one image, vector places each unique page image once per PDF")
+parser.add_argument('-st', '--strict', dest="STRICT", action="store_true", help="Stop on page size, DPI, mode and page count warnings, not just on missing or unreadable pages")
+parser.add_argument('-rgb', '--rgb', dest="GRAY", action="store_false", help="Always compose sheets in color, even if every page on them is grayscale or black and white")
+parser.add_argument('-gt', dest="GRAY_TOLERANCE", default=8, type=int, help="Largest difference between the color channels of a pixel (0-255) that still counts as gray")
+parser.add_argument('-w', '--watch', dest="WATCH", action="store_true", help="Keep running and rebuild the sheets and binders affected whenever a manifest or page changes")
+parser.add_argument('-tf', dest="TIMINGS_FILE", default="", help="Write the time, peak memory and output bytes of each stage as JSON to this file")
+parser.add_argument('-tr', '--trace', dest="TRACE_FILE", default="", help="Write an event per sheet and binder with its stage timings, bytes written and peak memory as JSON lines to this file")
+parser.add_argument('-cp', '--profile', dest="PROFILE_FILE", default="", help="Write cProfile statistics of the main process to this file")
 
 # init input
 args = parser.parse_args()
@@ -31,73 +62,383 @@ MANIFEST_DIR = BASE_DIR + args.MANIFEST_DIR
 INPUT_MANIFEST_FILES = [MANIFEST_DIR + f + '.csv' for f in args.INPUT_MANIFEST_FILES.split(",")]
 INPUT_DIR = BASE_DIR + args.INPUT_DIR
 OUTPUT_DIR = BASE_DIR + args.OUTPUT_DIR
+EBOOK_DIR = BASE_DIR + args.EBOOK_DIR if args.EBOOK_DIR else ""
 GUIDES = args.GUIDES
 COVER_GUTTER = args.COVER_GUTTER
 PAGE_GUTTER = args.PAGE_GUTTER
 PAGE_GUTTER_INCREMENT = args.PAGE_GUTTER_INCREMENT
+SIGNATURE_SHEETS = args.SIGNATURE_SHEETS
+IMPOSITION = args.IMPOSITION
+CACHE_SIZE = args.CACHE_SIZE
+DISK_CACHE_DIR = BASE_DIR + args.DISK_CACHE_DIR if args.DISK_CACHE_DIR else ""
+DISK_CACHE_SIZE = args.DISK_CACHE_SIZE
+BAND_MEMORY = args.BAND_MEMORY
+PROOF = args.PROOF
+JOBS = args.JOBS
+PREFETCH = args.PREFETCH
+FORCE = args.FORCE
+SHEET_FILES = args.SHEET_FILES
+STRICT = args.STRICT
+GRAY = args.GRAY
+GRAY_TOLERANCE = args.GRAY_TOLERANCE
+TIMINGS_FILE = args.TIMINGS_FILE
+TRACE_FILE = args.TRACE_FILE
+PROFILE_FILE = args.PROFILE_FILE
+WATCH = args.WATCH
+
+# Worker processes started by spawning rather than forking import this script again under another name, see the end of the script
+profiler = None
+if PROFILE_FILE and __name__ == "__main__":
+    profiler = cProfile.Profile()
+    profiler.enable()
+# only the main process writes the trace; workers hand their events back to it
+trace = Trace(TRACE_FILE, write=__name__ == "__main__")
 
 # config
 sheetW = 8.5
 sheetH = 11.0
-fileFormat = "PDF"
 fileExt = ".pdf"
+pdfResolution = 300 # pixels per inch used to lay out PDF pages
+guideFill = tuple([int(round(c * 255)) for c in GUIDE_COLOR]) # dark red, as on vector sheets
+bandPixelBytes = 10 # bytes per sheet pixel in a band: the band in RGB, plus the page rows read for it at up to 4 bytes per pixel and their converted copy
+watchInterval = 0.5 # seconds between checks for changed files in watch mode
 
 # ensure output dir exists
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
 # read manifest files
-manifest_files = []
-for mf in INPUT_MANIFEST_FILES:
-    with open(mf) as f:
-        r = csv.DictReader(f)
-        pages = []
-        for row in r:
-            row["file"] = INPUT_DIR + row["file"]
-            pages.append(row)
-        # Duplicate first and last two pages which are the cover pages
-        first = pages[0]
-        second = pages[1]
-        second_to_last = pages[-2]
-        last = pages[-1]
-        pages.insert(0, second)
-        pages.insert(0, first)
-        pages.append(second_to_last)
-        pages.append(last)
-        # add manifest file
-        manifest_files.append({
-            "file": mf,
-            "name": os.path.basename(mf).split(".")[0],
-            "pages": pages
-        })
-
-def mergePages(pages, filename):
-    merger = PdfFileMerger()
-
-    for p in pages:
-        f = open(p, "rb")
-        merger.append(f)
-
-    with open(filename, "wb") as outfile:
-        merger.write(outfile)
-        print "Saved binder: %s" % filename
-
-# read files from directory
-for f in manifest_files:
+def readManifests():
+    start = time.time()
+    manifest_files = []
+    for mf in INPUT_MANIFEST_FILES:
+        with open(mf) as f:
+            r = csv.DictReader(f)
+            pages = []
+            for row in r:
+                row["file"] = INPUT_DIR + row["file"]
+                pages.append(row)
+            manifestPages = list(pages)
+            # Duplicate first and last two pages which are the cover pages
+            first = pages[0]
+            second = pages[1]
+            second_to_last = pages[-2]
+            last = pages[-1]
+            pages.insert(0, second)
+            pages.insert(0, first)
+            pages.append(second_to_last)
+            pages.append(last)
+            # add manifest file
+            manifest_files.append({
+                "file": mf,
+                "name": os.path.basename(mf).split(".")[0],
+                "pages": pages,
+                "manifestPages": manifestPages
+            })
+    timer.add("manifest", time.time() - start)
+    return manifest_files
+
+# Check every page's header before rendering anything, so all problems are reported at once
+# Returns the number of errors
+def validateManifests(manifest_files):
+    with timer.stage("validate"):
+        probePages([page["file"] for f in manifest_files for page in f["pages"]])
+        problems = 0
+        for f in manifest_files:
+            (f["format"], errors, warnings) = checkPages(f["pages"], pdfResolution)
+            pageCount = len(f["pages"])
+            if pageCount % 4 != 0:
+                warnings.append("number of pages (%s) is not a multiple of 4" % pageCount)
+            elif pageCount % 8 != 0:
+                warnings.append("number of pages (%s) is not a multiple of 8" % pageCount)
+            if EBOOK_DIR and pageCount % 2 != 0:
+                warnings.append("number of pages (%s) is not even" % pageCount)
+            if STRICT:
+                errors += warnings
+                warnings = []
+            for message in warnings:
+                print "Warning: %s: %s" % (f["name"], message)
+            for message in errors:
+                print "Error: %s: %s" % (f["name"], message)
+            problems += len(errors)
+    return problems
+
+# Writes sheets to one PDF; each sheet is either a (page, images) pair held in memory or the file of a sheet saved earlier
+def bindSheets(sheets, filename):
+    with timer.stage("merge"):
+        binder = Binder(filename)
+        for sheet in sheets:
+            if isinstance(sheet, tuple):
+                binder.addSheet(*sheet)
+            else:
+                binder.addPdfPage(sheet)
+        binder.close()
+    timer.addBytes("merge", os.path.getsize(filename))
+    return filename
+
+def encode(image):
+    with timer.stage("encode"):
+        encoded = encodeImage(image)
+    timer.addBytes("encode", len(encoded["data"]))
+    return encoded
+
+# The smallest mode each page can be composed in without visible loss, keyed like the image cache so an edited page is checked again
+pageModes = {}
+
+def pageMode(key, image):
+    if not GRAY:
+        return "RGB"
+    cacheKey = imageCache.key(key)
+    if cacheKey not in pageModes:
+        with timer.stage("detect"):
+            pageModes[cacheKey] = simplestMode(image, GRAY_TOLERANCE)
+    return pageModes[cacheKey]
+
+def encodePage(key):
+    with trace.event("page", key) as event:
+        image = pageLoader.get(key)
+        mode = pageMode(key, image)
+        if mode != "RGB":
+            image = convertImage(image, mode)
+        encoded = encode(image)
+        event["bytes"] = len(encoded["data"])
+    return encoded
+
+# Starts encoding the page images of these sheets that are not encoded or being encoded yet
+def startEncoding(sheets):
+    for sheet in sheets:
+        for key, x, y in sheet["placements"]:
+            # PDF pages keep their reader open, so they are opened in this process
+            if not isPdf(key) and key not in encodedImages and key not in encodeJobs:
+                encodeJobs[key] = startJob(encodePage, key)
+
+def encodePages(sheets):
+    keys = []
+    for sheet in sheets:
+        for key, x, y in sheet["placements"]:
+            if key not in encodedImages and key not in keys:
+                keys.append(key)
+
+    startEncoding(sheets)
+    for key in keys:
+        if isPdf(key):
+            encodedImages[key] = openPdfPage(key)
+        else:
+            encodedImages[key] = encodeJobs.pop(key)()
+
+# Sheets whose pages are all grayscale or black and white are composed in that mode
+# Sheets with guides stay in color, so their guides are dark red like on color and vector sheets
+def sheetMode(sheet, modes):
+    if len(sheet["guides"]):
+        return "RGB"
+    return MODES[max([MODES.index(mode) for mode in modes])]
+
+def renderSheet(sheet):
+    images = [pageLoader.get(key) for key, x, y in sheet["placements"]]
+    mode = sheetMode(sheet, [pageMode(key, image) for (key, x, y), image in zip(sheet["placements"], images)])
+
+    # Create a blank image
+    with timer.stage("composite"):
+        imageBase = Image.new(mode, sheet["size"], "white")
+
+    # Paste the pages into the image
+    for (key, x, y), image in zip(sheet["placements"], images):
+        with timer.stage("composite"):
+            if mode != "RGB":
+                image = convertImage(image, mode)
+            imageBase.paste(image, (x, y))
+
+    # Draw guide lines
+    if len(sheet["guides"]):
+        with timer.stage("guides"):
+            draw = ImageDraw.Draw(imageBase)
+            for line in sheet["guides"]:
+                draw.line(line, fill=guideFill)
+            del draw
+
+    return imageBase
+
+# Decodes a page into the disk cache unless it is there already, so it can be read back a few rows at a time
+def storePage(key):
+    rows = diskCache.openRows(key, imageCache.resolution)
+    if rows is not None:
+        rows.close()
+        # pages cached by an earlier run still need their mode
+        if GRAY and imageCache.key(key) not in pageModes:
+            pageMode(key, diskCache.get(key, imageCache.resolution))
+        return
+    with timer.stage("decode"):
+        image = imageCache.decode(key)
+        if image.mode not in rowModes:
+            image = image.convert("RGB")
+    pageMode(key, image)
+    # replaces a page cached by a run without bands in a mode that cannot be read by rows
+    diskCache.put(key, image, imageCache.resolution, replace=True)
+
+# Composites and encodes a sheet a band of rows at a time, so memory depends on the band size rather than on the size of the sheet
+def renderSheetBands(sheet):
+    for key, x, y in sheet["placements"]:
+        storePage(key)
+    pages = [diskCache.openRows(key, imageCache.resolution) for key, x, y in sheet["placements"]]
+    mode = sheetMode(sheet, [pageMode(key, None) for key, x, y in sheet["placements"]])
+
+    (w, h) = sheet["size"]
+    bandH = max(1, BAND_MEMORY * 1024 * 1024 // (w * bandPixelBytes))
+    encoder = BandEncoder(mode, (w, h))
+    for y0 in range(0, h, bandH):
+        y1 = min(h, y0 + bandH)
+        with timer.stage("composite"):
+            band = Image.new(mode, (w, y1 - y0), "white")
+            for (key, x, y), rows in zip(sheet["placements"], pages):
+                top = max(y0, y)
+                bottom = min(y1, y + rows.size[1])
+                if top < bottom:
+                    band.paste(convertImage(rows.read(top - y, bottom - y), mode), (x, top - y0))
+
+        if len(sheet["guides"]):
+            with timer.stage("guides"):
+                draw = ImageDraw.Draw(band)
+                for (x0, gy0), (x1, gy1) in sheet["guides"]:
+                    draw.line([(x0, gy0 - y0), (x1, gy1 - y0)], fill=guideFill)
+                del draw
+
+        with timer.stage("encode"):
+            encoder.add(band)
+        del band
+
+    for rows in pages:
+        rows.close()
+    with timer.stage("encode"):
+        image = encoder.finish()
+    timer.addBytes("encode", len(image["data"]))
+    return image
+
+# A page showing a rendered sheet image, keyed by the sheet's digest so identical sheets share one image
+def sheetImagePage(sheet):
+    return {
+        "size": sheet["size"],
+        "resolution": sheet["resolution"],
+        "placements": [(sheet["digest"], 0, 0)],
+        "guides": []
+    }
+
+# Renders and encodes a sheet once, so the sheet file and every binder can embed the same data
+# Banded sheets outside watch mode are returned as the PDF file they were saved to, see bandSheetFiles
+def renderSheetImage(sheet, saveFile):
+    with trace.event("sheet", sheet["file"]) as event:
+        if BAND_MEMORY:
+            image = renderSheetBands(sheet)
+        else:
+            image = encode(renderSheet(sheet))
+        event["bytes"] = len(image["data"])
+        if saveFile:
+            bindSheets([(sheetImagePage(sheet), {sheet["digest"]: image})], sheet["file"])
+            event["bytes"] = os.path.getsize(sheet["file"])
+            print "Saved image: %s" % sheet["file"]
+    if bandSheetFiles:
+        if saveFile:
+            return sheet["file"]
+        return bindSheets([(sheetImagePage(sheet), {sheet["digest"]: image})], os.path.join(bandSheetDir, sheet["digest"] + ".pdf"))
+    return image
+
+# How a binder places a rendered sheet: a page showing its encoded image, or the PDF file it was saved to
+def renderedSheet(sheet, image):
+    if isinstance(image, dict):
+        return (sheetImagePage(sheet), {sheet["digest"]: image})
+    return image
+
+# Runs a job in a worker and reports the work its image cache did, the time it spent in each stage and its trace events
+def runJob(job):
+    (fn, args) = job
+    counters = imageCache.counters()
+    stages = timer.snapshot()
+    result = fn(*args)
+    return (result, [after - before for after, before in zip(imageCache.counters(), counters)], timer.since(stages), trace.takeEvents())
+
+# Starts a job on the worker pool, or runs it right away if there is no pool
+# Returns a function that waits for the job and returns its result; call it once
+def startJob(fn, *args):
+    if pool is None:
+        result = fn(*args)
+        return lambda: result
+    asyncResult = pool.apply_async(runJob, [(fn, args)])
+    def wait():
+        (result, counters, stages, events) = asyncResult.get()
+        imageCache.addCounters(counters)
+        timer.addStages(stages)
+        trace.addEvents(events)
+        return result
+    return wait
+
+# page images and PDF pages encoded for vector imposition, shared by every sheet and binder
+encodedImages = {}
+encodeJobs = {}
+
+# decoded page images, shared by every sheet; each worker process keeps its own cache, so each gets its share of the budget
+diskCache = None
+if DISK_CACHE_DIR:
+    diskCache = DiskCache(DISK_CACHE_DIR, DISK_CACHE_SIZE * 1024 * 1024)
+imageCache = ImageCache(CACHE_SIZE * 1024 * 1024 // max(1, JOBS), PROOF or None, diskCache)
+pageLoader = imageCache
+
+# Banded sheets are handed to the binders as the PDF files they were saved to, which binders copy from without loading them,
+# so lossless sheets do not stay in memory until their binders are written; without sheet files they are saved to a temporary folder
+# Watch mode keeps encoded images instead, since a later build may write over a sheet file
+bandSheetFiles = BAND_MEMORY and not WATCH
+
+# temporary folders of band mode; the main process makes them and hands them to every worker process
+bandCacheDir = None
+bandSheetDir = None
+
+def useTempDirs(pagesDir, sheetsDir):
+    global bandCacheDir, bandSheetDir, diskCache
+    bandCacheDir = pagesDir
+    bandSheetDir = sheetsDir
+    if pagesDir is not None:
+        # band compositing reads pages back from disk, so without a disk cache they are kept in a temporary one for this run
+        diskCache = DiskCache(pagesDir, DISK_CACHE_SIZE * 1024 * 1024)
+        imageCache.diskCache = diskCache
+
+# worker processes shared by the sheets and binders of every manifest
+pool = None
+
+# The page size and DPI to lay out a manifest with: the most common ones found by the validation
+def pageFormat(f):
+    (pageW, pageH) = f["format"]["size"]
+    dpi = (f["format"]["dpi"], f["format"]["dpi"])
+    # proofs lay out the same pages at a lower resolution
+    if PROOF:
+        (pageW, pageH) = scaledSize((pageW, pageH), dpi[0], PROOF)
+        dpi = (PROOF, PROOF)
+    return (pageW, pageH, dpi)
+
+# The indices of the pages on each image of a stack of nested sheets holding count pages from first on, from the outermost sheet in
+# Each sheet of paper is two images, front and back, with two folios of four pages each
+def nestedImages(first, count):
+    images = []
+    max_i = count - 1
+    for i in range(int(math.ceil(1.0 * count / 4))):
+        base_i = i * 2 - i % 2
+        page_indices = [max_i - base_i, base_i, max_i - (base_i+2), base_i+2]
+        if i % 2 != 0:
+            page_indices = [base_i, max_i - base_i, base_i+2, max_i - (base_i+2)]
+        images.append([first + pi for pi in page_indices])
+    return images
+
+# Lays out the sheets and binders of a book without rendering anything
+def planBook(f):
     pages = f["pages"]
     pageCount = len(pages)
-    imageCount = int(math.ceil(1.0 * pageCount / 4))
 
     print "Loading %s pages in %s" % (pageCount, f["name"])
-    if pageCount % 4 != 0:
-        print "Warning: number of pages is not a multiple of 4"
-    elif pageCount % 8 != 0:
-        print "Warning: number of pages is not a multiple of 8"
-
-    # get information about images
-    sampleImage = Image.open(pages[0]["file"])
-    dpi = sampleImage.info['dpi']
-    (pageW, pageH) = sampleImage.size
+
+    # PDF pages can only be placed, never composited
+    imposition = IMPOSITION
+    if imposition != "vector" and any([isPdf(page["file"]) for page in pages]):
+        print "Using vector imposition since %s contains PDF pages" % f["name"]
+        imposition = "vector"
+
+    (pageW, pageH, dpi) = pageFormat(f)
     print "Page size: %spx x %spx" % (pageW, pageH)
     print "Image DPI: %s x %s" % dpi
 
@@ -124,107 +465,360 @@ for f in manifest_files:
     binder_odd = []
     binder_even = []
     binder_covers = []
-
-    max_i = pageCount - 1
-    for i in range(imageCount):
-
-        # Determine what kind of image this is
-        isCover = False
-        if i <= 1:
-            isCover = True
-        isPage = not isCover
-        isEven = False
-        if i % 2 == 0:
-            isEven = True
-        isOdd = not isEven
-
-        # Create a blank image
-        imageBase = Image.new("RGB", (imageW, imageH), "white")
-
-        # Determine which pages go on this image
-        base_i = i * 2 - i % 2
-        page_indices = [max_i - base_i, base_i, max_i - (base_i+2), base_i+2]
-        if isOdd:
-            page_indices = [base_i, max_i - base_i, base_i+2, max_i - (base_i+2)]
-
-        # Determine the gutter
-        gutterMultiplier = int((imageCount-1-i) / 2)
-        gutter = PAGE_GUTTER + PAGE_GUTTER_INCREMENT * gutterMultiplier
-        if isCover:
-            gutter = COVER_GUTTER
-        gutter *= pxPerInch
-
-        # Odd pages should have space on left rather than right
-        offset_x = 0
-        if isOdd:
-            offset_x = int(round(imageW - pageW * 2 - gutter))
-
-        # Outer covers should be centered
-        adjustedGutter = gutter
-        if isCover and i < 1:
-            offset_x =  int(round(gutter * 0.25))
-            adjustedGutter =  int(round(gutter * 0.5))
-
-        print "Building image with pages (%s) and gutter (%spx)" % (", ".join([str(p) for p in page_indices]), gutter)
-
-        # Paste the pages into the image
-        x = offset_x
-        y = 0
-        for pi in page_indices:
-            page = pages[pi]
-
-            # Paste image
-            image = Image.open(page["file"])
-            imageBase.paste(image, (x, y))
-
-            # Make warnings if size mismatch
-            (thisW, thisH) = image.size
-            if thisW != pageW or thisH != pageH:
-                print "Warning: size mismatch for %s (%s x %s)" % (page["file"], thisW, thisH)
-
-            # place in a grid of 4
-            x += pageW + adjustedGutter
-            if x >= pageW * 2 + adjustedGutter:
-                x = offset_x
-                y += pageH
-            x = int(round(x))
-
-        # Put guide lines on every other image
-        if isEven and GUIDES:
-            draw = ImageDraw.Draw(imageBase)
-            margin = pxPerInch * 0.375 # the margin of the image
-            x = int(round(pageW * 2 + gutter + 1)) # the x position of right vertical guides
-            w = pxPerInch * 0.5 # the length of guide
-            draw.line([(x, margin), (x, w)], fill=128) # top, right, vertical
-            draw.line([(x, imageH-margin), (x, imageH-w)], fill=128) # bottom, right, vertical
-            draw.line([(margin, pageH), (w, pageH)], fill=128) # center, left, horizontal
-            draw.line([(x, pageH), (x-w+margin, pageH)], fill=128) # center, right, horizontal
-            del draw
-
-        # Save the image
-        page_type = "page"
-        if isCover:
-            page_type = "cover"
-        outputFile =  directory + "/" + page_type + "_" + format(i, '03') + fileExt
-        imageBase.save(outputFile, fileFormat, dpi=dpi, resolution=dpi[0])
-        print "Saved image: %s" % outputFile
-
-        # Build binders
-        if isPage:
-            binder.append(outputFile)
-            if isEven:
-                binder_even.append(outputFile)
+    sheets = []
+
+    # The whole book is nested as one stack; with signatures only the covers wrap the book and the pages inside them are nested in stacks of SIGNATURE_SHEETS sheets
+    groups = [nestedImages(0, pageCount)]
+    if SIGNATURE_SHEETS > 0:
+        groups = [groups[0][:2]]
+        signaturePages = SIGNATURE_SHEETS * 8
+        for first in range(4, pageCount - 4, signaturePages):
+            groups.append(nestedImages(first, min(signaturePages, pageCount - 4 - first)))
+        print "Splitting %s pages inside the covers into %s signatures" % (pageCount - 8, len(groups) - 1)
+    signatures = []
+
+    i = 0
+    for group, images in enumerate(groups):
+        signature = []
+        for group_i, page_indices in enumerate(images):
+
+            # Determine what kind of image this is
+            isCover = False
+            if group == 0 and group_i <= 1:
+                isCover = True
+            isPage = not isCover
+            isEven = False
+            if group_i % 2 == 0:
+                isEven = True
+            isOdd = not isEven
+
+            # Determine the gutter, which grows towards the outside of each stack
+            gutterMultiplier = int((len(images)-1-group_i) / 2)
+            gutter = PAGE_GUTTER + PAGE_GUTTER_INCREMENT * gutterMultiplier
+            if isCover:
+                gutter = COVER_GUTTER
+            gutter *= pxPerInch
+
+            # Odd pages should have space on left rather than right
+            offset_x = 0
+            if isOdd:
+                offset_x = int(round(imageW - pageW * 2 - gutter))
+
+            # Outer covers should be centered
+            adjustedGutter = gutter
+            if isCover and i < 1:
+                offset_x =  int(round(gutter * 0.25))
+                adjustedGutter =  int(round(gutter * 0.5))
+
+            print "Building image with pages (%s) and gutter (%spx)" % (", ".join([str(p) for p in page_indices]), gutter)
+
+            # Determine where the pages go on the image
+            placements = []
+            x = offset_x
+            y = 0
+            for pi in page_indices:
+                page = pages[pi]
+                placements.append((page["file"], x, y))
+
+                # place in a grid of 4
+                x += pageW + adjustedGutter
+                if x >= pageW * 2 + adjustedGutter:
+                    x = offset_x
+                    y += pageH
+                x = int(round(x))
+
+            # Put guide lines on every other image
+            guides = []
+            if isEven and GUIDES:
+                margin = pxPerInch * 0.375 # the margin of the image
+                x = int(round(pageW * 2 + gutter + 1)) # the x position of right vertical guides
+                w = pxPerInch * 0.5 # the length of guide
+                guides.append([(x, margin), (x, w)]) # top, right, vertical
+                guides.append([(x, imageH-margin), (x, imageH-w)]) # bottom, right, vertical
+                guides.append([(margin, pageH), (w, pageH)]) # center, left, horizontal
+                guides.append([(x, pageH), (x-w+margin, pageH)]) # center, right, horizontal
+
+            page_type = "page"
+            if isCover:
+                page_type = "cover"
+            outputFile =  directory + "/" + page_type + "_" + format(i, '03') + fileExt
+            sheet = {
+                "file": outputFile,
+                "size": (imageW, imageH),
+                "dpi": dpi,
+                "resolution": dpi[0],
+                "placements": placements,
+                "guides": guides
+            }
+            # The placements and guides capture the gutters, guide settings and sheet size, so together with the page contents they decide the output
+            settings = [GRAY, GRAY_TOLERANCE]
+            if BAND_MEMORY and imposition != "vector":
+                # banded sheets are stored losslessly, so they differ from whole sheets stored as JPEG
+                settings.append("bands")
+            sheet["digest"] = digest([imposition, sheet["size"], sheet["dpi"], guides, settings, [(fileDigest(key), px, py) for key, px, py in placements]])
+            sheets.append(sheet)
+
+            # Build binders
+            if isPage:
+                binder.append(sheet)
+                if isEven:
+                    binder_even.append(sheet)
+                else:
+                    binder_odd.append(sheet)
             else:
-                binder_odd.append(outputFile)
+                binder_covers.append(sheet)
+            signature.append(sheet)
+            i += 1
+        if group > 0:
+            signatures.append(signature)
+
+    binders = []
+    # each signature also gets a binder of its own, so it can be printed again on its own
+    signatureBinders = [(signatureSheets, "signature_" + format(n + 1, '02')) for n, signatureSheets in enumerate(signatures)]
+    for binderSheets, name in [(binder, "binder"), (binder_even, "binder_even"), (binder_odd, "binder_odd"), (binder_covers, "binder_covers")] + signatureBinders:
+        if len(binderSheets):
+            binders.append({
+                "file": directory + "/" + name + fileExt,
+                "sheets": binderSheets,
+                "digest": digest([binderSheet["digest"] for binderSheet in binderSheets])
+            })
+
+    return {
+        "name": f["name"],
+        "imposition": imposition,
+        "sheets": sheets,
+        "binders": binders,
+        "cache": BuildCache(directory + "/.buildcache.json")
+    }
+
+# ebook pages: PNGs embedded as they are, other pages encoded as for vector sheets
+ebookImages = {}
+
+def encodeEbookPages(pageFiles):
+    placements = []
+    for key in pageFiles:
+        if key in ebookImages or key in encodedImages or (key, 0, 0) in placements:
+            continue
+        encoded = None
+        # proofs change the size of every page, so they are always decoded
+        if not PROOF and not isPdf(key):
+            with timer.stage("read"):
+                encoded = readPng(key)
+        if encoded is None:
+            placements.append((key, 0, 0))
+        else:
+            ebookImages[key] = encoded
+    # encodePages only looks at the placements of the sheets
+    encodePages([{"placements": placements}])
+    for key in pageFiles:
+        if key not in ebookImages:
+            ebookImages[key] = encodedImages[key]
+
+# encoded images (or saved files, see bandSheetFiles) of the raster sheets rendered so far, by sheet digest, so a later build in watch mode can reuse them
+sheetImages = {}
+
+# Builds every sheet and binder whose inputs changed, and the ebooks of every manifest, or only of those using one of the changed files
+# Returns whether the manifests were valid and the files the build read
+def build(changed=None):
+    global pageLoader
+    manifest_files = readManifests()
+    watchedFiles = list(INPUT_MANIFEST_FILES) + [page["file"] for f in manifest_files for page in f["manifestPages"]]
+    problems = validateManifests(manifest_files)
+    if problems > 0:
+        print "Found %s problems in the manifests; nothing was rendered" % problems
+        return (False, watchedFiles)
+
+    # read files from directory
+    with timer.stage("plan"):
+        books = [planBook(f) for f in manifest_files]
+
+    # Only rebuild the sheets and binders whose inputs changed since the last run
+    for book in books:
+        cache = book["cache"]
+        book["staleBinders"] = [binder for binder in book["binders"] if FORCE or not cache.isFresh(binder["file"], binder["digest"])]
+        if SHEET_FILES:
+            # binders read unchanged sheets back from their files
+            book["staleSheets"] = [sheet for sheet in book["sheets"] if FORCE or not cache.isFresh(sheet["file"], sheet["digest"])]
+        else:
+            book["staleSheets"] = [sheet for sheet in book["sheets"] if any([sheet in binder["sheets"] for binder in book["staleBinders"]])]
+        unchanged = len(book["sheets"]) - len(book["staleSheets"]) + len(book["binders"]) - len(book["staleBinders"])
+        if unchanged > 0:
+            print "Skipping %s unchanged files in %s" % (unchanged, book["name"])
+
+    # Without worker processes, this process requests the pages in this order, so the image cache only keeps pages that are requested again,
+    # and upcoming pages are decoded in the background while it composites and encodes
+    # Banded sheets read their pages from disk, so keeping decoded pages in memory ahead of them would only add to the memory they save
+    if pool is None and not BAND_MEMORY:
+        upcoming = []
+        seen = set()
+        for book in books:
+            for sheet in book["staleSheets"]:
+                if book["imposition"] == "vector":
+                    keys = [key for key, x, y in sheet["placements"] if not isPdf(key) and key not in encodedImages and key not in seen]
+                elif sheet["digest"] not in seen:
+                    seen.add(sheet["digest"])
+                    keys = [key for key, x, y in sheet["placements"]]
+                else:
+                    keys = []
+                seen.update(keys)
+                upcoming += keys
+        imageCache.plan(upcoming)
+        if PREFETCH > 0:
+            pageLoader = Prefetcher(imageCache, upcoming, PREFETCH)
+
+    # Start every sheet of every book on the shared pool; a sheet that is identical in several books, or was rendered by an earlier build, is only rendered once
+    sheetJobs = {} # sheet digest => function waiting for its encoded image
+    sheetOwners = {} # sheet digest => file of the sheet that renders it
+    for book in books:
+        if book["imposition"] == "vector":
+            startEncoding(book["staleSheets"])
+            continue
+        for sheet in book["staleSheets"]:
+            if sheet["digest"] not in sheetJobs and sheet["digest"] not in sheetImages:
+                sheetJobs[sheet["digest"]] = startJob(renderSheetImage, sheet, SHEET_FILES)
+                sheetOwners[sheet["digest"]] = sheet["file"]
+    rasterSheets = sum([len(book["staleSheets"]) for book in books if book["imposition"] != "vector"])
+    if rasterSheets > len(sheetJobs):
+        print "Rendering %s unique sheets for %s sheets" % (len(sheetJobs), rasterSheets)
+
+    def renderedSheetImage(sheet):
+        if sheet["digest"] not in sheetImages:
+            sheetImages[sheet["digest"]] = sheetJobs.pop(sheet["digest"])()
+        return sheetImages[sheet["digest"]]
+
+    # Finish the books in order, writing each book's binders as soon as its sheets are done
+    for book in books:
+        cache = book["cache"]
+        rendered = {} # sheet file => (page, images) to place it in a binder
+        if book["imposition"] == "vector":
+            # vector sheets only place already encoded images, so they are assembled here
+            for sheet in book["staleSheets"]:
+                with trace.event("sheet", sheet["file"]) as event:
+                    encodePages([sheet])
+                    rendered[sheet["file"]] = (sheet, encodedImages)
+                    if SHEET_FILES:
+                        bindSheets([rendered[sheet["file"]]], sheet["file"])
+                        event["bytes"] = os.path.getsize(sheet["file"])
+                        print "Saved image: %s" % sheet["file"]
         else:
-            binder_covers.append(outputFile)
-
-    # Make pdf binders
-    if len(binder):
-        mergePages(binder, directory + "/" + "binder" + fileExt)
-    if len(binder_even):
-        mergePages(binder_even, directory + "/" + "binder_even" + fileExt)
-    if len(binder_odd):
-        mergePages(binder_odd, directory + "/" + "binder_odd" + fileExt)
-    if len(binder_covers):
-        mergePages(binder_covers, directory + "/" + "binder_covers" + fileExt)
+            for sheet in book["staleSheets"]:
+                rendered[sheet["file"]] = renderedSheet(sheet, renderedSheetImage(sheet))
+                # the rendering job only saved the file of the sheet it was started for
+                owner = sheetOwners.get(sheet["digest"])
+                if SHEET_FILES and owner != sheet["file"]:
+                    with trace.event("sheet", sheet["file"]) as event:
+                        bindSheets([rendered[sheet["file"]]], sheet["file"])
+                        event["bytes"] = os.path.getsize(sheet["file"])
+                        event["sameAs"] = owner
+                    if owner is None:
+                        print "Saved image: %s" % sheet["file"]
+                    else:
+                        print "Saved image: %s (same as %s)" % (sheet["file"], owner)
+        if SHEET_FILES:
+            for sheet in book["staleSheets"]:
+                cache.update(sheet["file"], sheet["digest"])
+        # unchanged sheets still in memory from an earlier build are not read back from their files
+        if book["imposition"] != "vector":
+            for sheet in book["sheets"]:
+                if sheet["file"] not in rendered and sheet["digest"] in sheetImages:
+                    rendered[sheet["file"]] = renderedSheet(sheet, sheetImages[sheet["digest"]])
+
+        for binder in book["staleBinders"]:
+            with trace.event("binder", binder["file"]) as event:
+                bindSheets([rendered.get(sheet["file"], sheet["file"]) for sheet in binder["sheets"]], binder["file"])
+                event["bytes"] = os.path.getsize(binder["file"])
+                event["sheets"] = len(binder["sheets"])
+            cache.update(binder["file"], binder["digest"])
+            print "Saved binder: %s" % binder["file"]
+        cache.save()
+
+    # Build the ebooks from the same manifests, cached page images, encoded pages and worker processes as the print run
+    if EBOOK_DIR:
+        for f in manifest_files:
+            # in watch mode, only ebooks whose manifest changed or that show a changed page are written again
+            if changed is not None and f["file"] not in changed and not any([page["file"] in changed for page in f["manifestPages"]]):
+                continue
+            directory = EBOOK_DIR + f["name"]
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            (pageW, pageH, dpi) = pageFormat(f)
+            plan = planEbook(f["manifestPages"], directory, fileExt)
+            encodeEbookPages(ebookPageFiles(plan))
+            writeEbook(plan, (pageW, pageH), dpi[0], ebookImages.get)
+
+    if pageLoader is not imageCache:
+        pageLoader.close()
+        pageLoader = imageCache
+
+    # only keep the sheets the books still use
+    digests = set([sheet["digest"] for book in books for sheet in book["sheets"]])
+    for key in list(sheetImages.keys()):
+        if key not in digests:
+            del sheetImages[key]
+
+    print "Image cache: %s" % imageCache.summary()
+    if TIMINGS_FILE:
+        timer.save(TIMINGS_FILE)
+    return (True, watchedFiles)
+
+# Drops what was encoded from files that changed, so the next build encodes them again
+def forget(changed):
+    for key in changed:
+        encodedImages.pop(key, None)
+        ebookImages.pop(key, None)
+
+# Worker processes started by spawning import this script as another module, so only the main process runs the build
+if __name__ == "__main__":
+    pagesDir = None
+    if BAND_MEMORY and not DISK_CACHE_DIR:
+        pagesDir = tempfile.mkdtemp(prefix="pages_")
+    sheetsDir = None
+    if bandSheetFiles and not SHEET_FILES:
+        sheetsDir = tempfile.mkdtemp(prefix="sheets_")
+    useTempDirs(pagesDir, sheetsDir)
+    if JOBS > 1:
+        pool = multiprocessing.Pool(JOBS, useTempDirs, (bandCacheDir, bandSheetDir))
+
+    if not WATCH:
+        (ok, watchedFiles) = build()
+    else:
+        # Build, then build again whenever a manifest or page changes, keeping every cache and worker process
+        watcher = Watcher(watchInterval)
+        watchedFiles = list(INPUT_MANIFEST_FILES)
+        pending = None # files changed since the last successful build, or None to write every ebook
+        try:
+            while True:
+                start = time.time()
+                try:
+                    (ok, watchedFiles) = build(pending)
+                    print "Built in %ss; watching %s files for changes (Ctrl+C to stop)" % (round(time.time() - start, 2), len(set(watchedFiles)))
+                    if ok:
+                        pending = set()
+                except Exception:
+                    # e.g. a page that is still being saved; the next change starts another build
+                    traceback.print_exc()
+                    if pageLoader is not imageCache:
+                        pageLoader.close()
+                        pageLoader = imageCache
+                changed = watcher.wait(list(set(watchedFiles)))
+                print "Changed: %s" % ", ".join(changed)
+                forget(changed)
+                if pending is not None:
+                    pending.update(changed)
+        except KeyboardInterrupt:
+            print "Stopped watching"
+            ok = True
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if bandCacheDir is not None:
+        shutil.rmtree(bandCacheDir, True)
+    if bandSheetDir is not None:
+        shutil.rmtree(bandSheetDir, True)
+    trace.close()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(PROFILE_FILE)
+    if not ok:
+        sys.exit(1)
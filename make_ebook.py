@@ -6,11 +6,16 @@
 
 import argparse
 import csv
-import math
 import os
-from PIL import Image, ImageDraw
-from PyPDF2 import PdfFileMerger
+from ebook import ebookPageFiles, planEbook, writeEbook
+from imagecache import DiskCache, ImageCache, Prefetcher, scaledSize
+from imposition import convertImage, encodeImage, isPdf, readPng, simplestMode
+from pageprobe import checkPages, probePages
+from stagetimer import timer
 import sys
+import time
+import traceback
+from watch import Watcher
 
 # input
 parser = argparse.ArgumentParser()
@@ -19,6 +24,17 @@ parser.add_argument('-mf', dest="INPUT_MANIFEST_FILES", default="red,yellow,blue
 parser.add_argument('-md', dest="MANIFEST_DIR", default="manifest/", help="Directory of manifest files")
 parser.add_argument('-id', dest="INPUT_DIR", default="pages/", help="Directory of input files/pages")
 parser.add_argument('-od', dest="OUTPUT_DIR", default="ebook/", help="Directory for output files")
+parser.add_argument('-pf', dest="PREFETCH", default=8, type=int, help="Number of upcoming page images to decode in the background; 0 turns read-ahead off")
+parser.add_argument('-pr', '--proof', dest="PROOF", default=0, type=int, help="Render low resolution proofs at this DPI")
+parser.add_argument('-cs', dest="CACHE_SIZE", default=64, type=int, help="Memory budget for decoded page images in megabytes; only pages used again later and pages read ahead are kept")
+parser.add_argument('-dc', dest="DISK_CACHE_DIR", default="", help="Directory to keep decoded page images in between runs; off by default")
+parser.add_argument('-dcs', dest="DISK_CACHE_SIZE", default=4096, type=int, help="Disk budget for decoded page images in megabytes")
+parser.add_argument('-st', '--strict', dest="STRICT", action="store_true", help="Stop on page size, DPI, mode and page count warnings, not just on missing or unreadable pages")
+parser.add_argument('-rc', '--recompress', dest="PASSTHROUGH", action="store_false", help="Decode and re-encode every page instead of embedding PNG data as it is; slower, but grayscale pages come out smaller")
+parser.add_argument('-rgb', '--rgb', dest="GRAY", action="store_false", help="Always store decoded pages in color, even if they are grayscale or black and white")
+parser.add_argument('-gt', dest="GRAY_TOLERANCE", default=8, type=int, help="Largest difference between the color channels of a pixel (0-255) that still counts as gray")
+parser.add_argument('-w', '--watch', dest="WATCH", action="store_true", help="Keep running and write the ebooks again whenever a manifest or page changes")
+parser.add_argument('-tf', dest="TIMINGS_FILE", default="", help="Write the time, peak memory and output bytes of each stage as JSON to this file")
 
 # init input
 args = parser.parse_args()
@@ -27,125 +43,212 @@ MANIFEST_DIR = BASE_DIR + args.MANIFEST_DIR
 INPUT_MANIFEST_FILES = [MANIFEST_DIR + f + '.csv' for f in args.INPUT_MANIFEST_FILES.split(",")]
 INPUT_DIR = BASE_DIR + args.INPUT_DIR
 OUTPUT_DIR = BASE_DIR + args.OUTPUT_DIR
+CACHE_SIZE = args.CACHE_SIZE
+DISK_CACHE_DIR = BASE_DIR + args.DISK_CACHE_DIR if args.DISK_CACHE_DIR else ""
+DISK_CACHE_SIZE = args.DISK_CACHE_SIZE
+PREFETCH = args.PREFETCH
+PROOF = args.PROOF
+TIMINGS_FILE = args.TIMINGS_FILE
+STRICT = args.STRICT
+PASSTHROUGH = args.PASSTHROUGH
+GRAY = args.GRAY
+GRAY_TOLERANCE = args.GRAY_TOLERANCE
+WATCH = args.WATCH
 
 # config
-sheetW = 8.5
-sheetH = 11.0
-fileFormat = "PDF"
 fileExt = ".pdf"
+pdfResolution = 300 # pixels per inch to measure PDF pages at when checking the manifests, which then reject them, see validateManifests
+watchInterval = 0.5 # seconds between checks for changed files in watch mode
 
 # ensure output dir exists
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
 # read manifest files
-manifest_files = []
-for mf in INPUT_MANIFEST_FILES:
-    with open(mf) as f:
-        r = csv.DictReader(f)
-        pages = []
-        for row in r:
-            row["file"] = INPUT_DIR + row["file"]
-            pages.append(row)
-        # add manifest file
-        manifest_files.append({
-            "file": mf,
-            "name": os.path.basename(mf).split(".")[0],
-            "pages": pages
-        })
-
-def imagesToPDF(filePaths, pageW, pageH, fileName, fileFormat, dpi):
-    img = False
-
-    # Just one file
-    if len(filePaths)==1:
-        filePath = filePaths[0]
-        img = Image.open(filePath)
-        warnSizeMismatch(filePath, img.size, (pageW, pageH))
-
-    # more than one file
-    elif len(filePaths) > 1:
-        # Create a blank image and paste each image on it
-        img = Image.new("RGB", (pageW * len(filePaths), pageH), "white")
-        for i, filePath in enumerate(filePaths):
-            subImg = Image.open(filePath)
-            warnSizeMismatch(filePath, subImg.size, (pageW, pageH))
-            img.paste(subImg, (i*pageW, 0))
-
-    # Save image
-    if img:
-        img.save(fileName, fileFormat, dpi=dpi, resolution=dpi[0])
-        print "Saved image: %s" % fileName
-
-    return fileName
-
-def mergePages(pages, filename):
-    merger = PdfFileMerger()
-
-    for p in pages:
-        f = open(p, "rb")
-        merger.append(f)
-
-    with open(filename, "wb") as outfile:
-        merger.write(outfile)
-        print "Saved binder: %s" % filename
-
-def warnSizeMismatch(name, a, b):
-    if a[0]!=b[0] or a[1]!=b[1]:
-        print "Size mismatch: %s (%s x %s) != (%s x %s)" % (name, a[0], b[0], a[1], b[1])
-
-# read files from directory
-for f in manifest_files:
-    pages = f["pages"]
-    pageCount = len(pages)
-    imageCount = int(math.ceil(1.0 * pageCount / 4))
-
-    print "Loading %s pages in %s" % (pageCount, f["name"])
-    if pageCount % 2 != 0:
-        print "Warning: number of pages is not even"
-
-    # get information about images
-    sampleImage = Image.open(pages[0]["file"])
-    dpi = sampleImage.info['dpi']
-    (pageW, pageH) = sampleImage.size
-    print "Page size: %spx x %spx" % (pageW, pageH)
-    print "Image DPI: %s x %s" % dpi
-
-    # calculate image sizes
-    spreadW = pageW * 2
-    print "Creating covers at (%s x %s)" % (pageW, pageH)
-    print "Creating spreads at (%s x %s)" % (spreadW, pageH)
-
-    # ensure directory exists
-    directory = OUTPUT_DIR + f["name"]
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    # initialize binders
-    binder = []
-    binder_combined_covers = []
-
-    # retrieve covers
-    frontCover = pages.pop(0)
-    backCover = pages.pop()
-
-    # build covers
-    frontFile = imagesToPDF([frontCover["file"]], pageW, pageH, directory + "/cover_front" + fileExt, fileFormat, dpi)
-    backFile = imagesToPDF([backCover["file"]], pageW, pageH, directory + "/cover_back" + fileExt, fileFormat, dpi)
-    binder.append(frontFile)
-    combinedCoverFile = imagesToPDF([backCover["file"], frontCover["file"]], pageW, pageH, directory + "/spread_covers" + fileExt, fileFormat, dpi)
-    binder_combined_covers.append(combinedCoverFile)
-
-    for i in xrange(0, len(pages), 2):
-        outputFile =  directory + "/spread_" + format(int(i/2), '03') + fileExt
-        outputFile = imagesToPDF([pages[i]["file"], pages[i+1]["file"]], pageW, pageH, outputFile, fileFormat, dpi)
-        binder.append(outputFile)
-        binder_combined_covers.append(outputFile)
-
-    binder.append(backFile)
-
-    # Make pdf binders
-    if len(binder):
-        mergePages(binder, directory + "/" + "binder" + fileExt)
-    if len(binder_combined_covers):
-        mergePages(binder_combined_covers, directory + "/" + "binder_combined_covers" + fileExt)
+def readManifests():
+    start = time.time()
+    manifest_files = []
+    for mf in INPUT_MANIFEST_FILES:
+        with open(mf) as f:
+            r = csv.DictReader(f)
+            pages = []
+            for row in r:
+                row["file"] = INPUT_DIR + row["file"]
+                pages.append(row)
+            # add manifest file
+            manifest_files.append({
+                "file": mf,
+                "name": os.path.basename(mf).split(".")[0],
+                "pages": pages
+            })
+    timer.add("manifest", time.time() - start)
+    return manifest_files
+
+# Check every page's header before rendering anything, so all problems are reported at once
+# Returns the number of errors
+def validateManifests(manifest_files):
+    with timer.stage("validate"):
+        probePages([page["file"] for f in manifest_files for page in f["pages"]])
+        problems = 0
+        for f in manifest_files:
+            (f["format"], errors, warnings) = checkPages(f["pages"], pdfResolution)
+            errors += ["%s: PDF pages are only supported by make_book.py" % page["file"] for page in f["pages"] if isPdf(page["file"])]
+            if len(f["pages"]) % 2 != 0:
+                warnings.append("number of pages (%s) is not even" % len(f["pages"]))
+            if STRICT:
+                errors += warnings
+                warnings = []
+            for message in warnings:
+                print "Warning: %s: %s" % (f["name"], message)
+            for message in errors:
+                print "Error: %s: %s" % (f["name"], message)
+            problems += len(errors)
+    return problems
+
+# The smallest mode each page can be composed in without visible loss
+pageModes = {}
+
+def pageMode(filePath, image):
+    if not GRAY:
+        return "RGB"
+    if filePath not in pageModes:
+        with timer.stage("detect"):
+            pageModes[filePath] = simplestMode(image, GRAY_TOLERANCE)
+    return pageModes[filePath]
+
+# PNG pages embedded as they are, or None for pages that have to be decoded
+pngPages = {}
+
+def pngPage(filePath):
+    if filePath not in pngPages:
+        pngPages[filePath] = None
+        # proofs change the size of every page, so they are always decoded
+        if PASSTHROUGH and not PROOF:
+            with timer.stage("read"):
+                pngPages[filePath] = readPng(filePath)
+    return pngPages[filePath]
+
+# Each page is encoded once, no matter how many pages, spreads and binders show it
+encodedPages = {}
+
+def encodedPage(filePath):
+    if filePath not in encodedPages:
+        encoded = pngPage(filePath)
+        if encoded is None:
+            image = pageLoader.get(filePath)
+            mode = pageMode(filePath, image)
+            with timer.stage("encode"):
+                encoded = encodeImage(convertImage(image, mode))
+            timer.addBytes("encode", len(encoded["data"]))
+        encodedPages[filePath] = encoded
+    return encodedPages[filePath]
+
+# decoded page images, shared by every page and spread
+diskCache = None
+if DISK_CACHE_DIR:
+    diskCache = DiskCache(DISK_CACHE_DIR, DISK_CACHE_SIZE * 1024 * 1024)
+imageCache = ImageCache(CACHE_SIZE * 1024 * 1024, PROOF or None, diskCache)
+pageLoader = imageCache
+
+# Writes the ebook of every manifest, or only of those using one of the changed files
+# Returns whether the manifests were valid and the files the build read
+def build(changed=None):
+    global pageLoader
+    manifest_files = readManifests()
+    watchedFiles = list(INPUT_MANIFEST_FILES) + [page["file"] for f in manifest_files for page in f["pages"]]
+    problems = validateManifests(manifest_files)
+    if problems > 0:
+        print "Found %s problems in the manifests; nothing was rendered" % problems
+        return (False, watchedFiles)
+
+    # read files from directory
+    for f in manifest_files:
+        # in watch mode, only manifests that changed or show a changed page are written again
+        if changed is not None and f["file"] not in changed and not any([page["file"] in changed for page in f["pages"]]):
+            continue
+
+        pages = f["pages"]
+        pageCount = len(pages)
+
+        print "Loading %s pages in %s" % (pageCount, f["name"])
+
+        # lay out the most common page size and DPI found by the validation
+        (pageW, pageH) = f["format"]["size"]
+        dpi = (f["format"]["dpi"], f["format"]["dpi"])
+        # proofs lay out the same pages at a lower resolution
+        if PROOF:
+            (pageW, pageH) = scaledSize((pageW, pageH), dpi[0], PROOF)
+            dpi = (PROOF, PROOF)
+        print "Page size: %spx x %spx" % (pageW, pageH)
+        print "Image DPI: %s x %s" % dpi
+
+        # calculate image sizes
+        spreadW = pageW * 2
+        print "Creating covers at (%s x %s)" % (pageW, pageH)
+        print "Creating spreads at (%s x %s)" % (spreadW, pageH)
+
+        # ensure directory exists
+        directory = OUTPUT_DIR + f["name"]
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # covers on their own, inner pages as spreads
+        plan = planEbook(pages, directory, fileExt)
+
+        # decode upcoming pages that can't be embedded as they are in the background, in the order they are used
+        # each page is encoded once, so the image cache only keeps it until then
+        upcoming = [filePath for filePath in ebookPageFiles(plan) if filePath not in encodedPages and pngPage(filePath) is None]
+        imageCache.plan(upcoming)
+        if PREFETCH > 0:
+            pageLoader = Prefetcher(imageCache, upcoming, PREFETCH)
+
+        writeEbook(plan, (pageW, pageH), dpi[0], encodedPage)
+
+        if pageLoader is not imageCache:
+            pageLoader.close()
+            pageLoader = imageCache
+
+    print "Image cache: %s" % imageCache.summary()
+    if TIMINGS_FILE:
+        timer.save(TIMINGS_FILE)
+    return (True, watchedFiles)
+
+# Drops what was read from files that changed, so the next build reads them again
+def forget(changed):
+    for filePath in changed:
+        pageModes.pop(filePath, None)
+        pngPages.pop(filePath, None)
+        encodedPages.pop(filePath, None)
+
+if not WATCH:
+    (ok, watchedFiles) = build()
+else:
+    # Build, then build again whenever a manifest or page changes, keeping the decoded and encoded pages
+    watcher = Watcher(watchInterval)
+    watchedFiles = list(INPUT_MANIFEST_FILES)
+    pending = None # files changed since the last successful build, or None to write every ebook
+    try:
+        while True:
+            start = time.time()
+            try:
+                (ok, watchedFiles) = build(pending)
+                print "Built in %ss; watching %s files for changes (Ctrl+C to stop)" % (round(time.time() - start, 2), len(set(watchedFiles)))
+                if ok:
+                    pending = set()
+            except Exception:
+                # e.g. a page that is still being saved; the next change starts another build
+                traceback.print_exc()
+                if pageLoader is not imageCache:
+                    pageLoader.close()
+                    pageLoader = imageCache
+            changed = watcher.wait(list(set(watchedFiles)))
+            print "Changed: %s" % ", ".join(changed)
+            forget(changed)
+            if pending is not None:
+                pending.update(changed)
+    except KeyboardInterrupt:
+        print "Stopped watching"
+        ok = True
+
+if not ok:
+    sys.exit(1)
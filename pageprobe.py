@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Description: reads the size, DPI and mode of page files from their headers without decoding pixels, so every problem can be reported before rendering
+# Probes are kept per path, modification time and size, so later stages use them without opening the files again
+
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+import os
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from imposition import isPdf
+
+# modes PIL can paste onto a sheet as they are
+pageModes = ["1", "L", "LA", "P", "RGB", "RGBA"]
+
+# probes of page files, keyed by path, modification time and size
+probes = {}
+
+def probePage(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return {"file": filename, "error": "file not found"}
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    if key in probes:
+        return probes[key]
+
+    probe = {"file": filename, "error": None, "pdf": isPdf(filename)}
+    try:
+        with open(filename, "rb") as f:
+            if probe["pdf"]:
+                page = PdfFileReader(f).getPage(0)
+                probe["box"] = tuple([float(v) for v in page.cropBox])
+            else:
+                # PIL only reads the header until the pixels are accessed
+                image = Image.open(f)
+                probe["size"] = image.size
+                probe["mode"] = image.mode
+                probe["dpi"] = None
+                if "dpi" in image.info:
+                    probe["dpi"] = int(round(image.info["dpi"][0]))
+    except Exception as e:
+        probe["error"] = "unreadable (%s)" % e
+    probes[key] = probe
+    return probe
+
+# Probes many files at once; reading headers mostly waits on the disk, so threads overlap well
+def probePages(filenames, threads=8):
+    filenames = list(set(filenames))
+    pool = ThreadPool(threads)
+    results = pool.map(probePage, filenames)
+    pool.close()
+    pool.join()
+    return dict(zip(filenames, results))
+
+# Size in pixels and DPI of a probed page; PDF pages are measured at the given resolution
+def pageFormat(probe, pdfResolution):
+    if probe["pdf"]:
+        (llx, lly, urx, ury) = probe["box"]
+        return ((int(round((urx - llx) * pdfResolution / 72.0)), int(round((ury - lly) * pdfResolution / 72.0))), pdfResolution)
+    return (probe["size"], probe["dpi"])
+
+# Checks the pages of one manifest against each other
+# Returns the most common page size and DPI, which the layout uses, and lists of errors and warnings
+def checkPages(pages, pdfResolution):
+    errors = []
+    warnings = []
+    sizes = Counter()
+    dpis = Counter()
+    files = []
+    for page in pages:
+        if page["file"] not in files:
+            files.append(page["file"])
+    for filename in files:
+        probe = probePage(filename)
+        if probe["error"]:
+            errors.append("%s: %s" % (filename, probe["error"]))
+            continue
+        (size, dpi) = pageFormat(probe, pdfResolution)
+        sizes[size] += 1
+        if dpi is not None:
+            dpis[dpi] += 1
+
+    if not len(sizes):
+        return (None, errors, warnings)
+    if not len(dpis):
+        errors.append("no page has a DPI")
+        return (None, errors, warnings)
+    size = sizes.most_common(1)[0][0]
+    dpi = dpis.most_common(1)[0][0]
+
+    for filename in files:
+        probe = probePage(filename)
+        if probe["error"]:
+            continue
+        (thisSize, thisDpi) = pageFormat(probe, pdfResolution)
+        if thisSize != size:
+            warnings.append("%s: size mismatch (%s x %s), most pages are (%s x %s)" % (filename, thisSize[0], thisSize[1], size[0], size[1]))
+        if thisDpi is None:
+            warnings.append("%s: no DPI, assuming %s" % (filename, dpi))
+        elif thisDpi != dpi:
+            warnings.append("%s: %s DPI, most pages are %s DPI" % (filename, thisDpi, dpi))
+        if not probe["pdf"] and probe["mode"] not in pageModes:
+            warnings.append("%s: unusual image mode %s" % (filename, probe["mode"]))
+
+    return ({"size": size, "dpi": dpi}, errors, warnings)
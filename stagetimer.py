@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Description: accumulates wall time, peak memory and output bytes for each stage of a run, e.g. for benchmarks
+# Seconds are summed over every call of a stage, so stages run on several threads or processes can add up to more than the run took
+# Peak memory is the process's peak resident size when a stage last finished, in bytes
+# A trace adds one event per sheet or binder on top of the totals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Python 3 only
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def peakRss():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform != "darwin":
+        rss *= 1024
+    return rss
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.stages = OrderedDict() # name => {"seconds", "calls", "bytes", "peakRss"}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds=0.0, calls=1, bytes=0):
+        rss = peakRss()
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {"seconds": 0.0, "calls": 0, "bytes": 0, "peakRss": 0}
+            stage = self.stages[name]
+            stage["seconds"] += seconds
+            stage["calls"] += calls
+            stage["bytes"] += bytes
+            stage["peakRss"] = max(stage["peakRss"], rss)
+
+    def addBytes(self, name, bytes):
+        self.add(name, calls=0, bytes=bytes)
+
+    # Copy of the stages so far; workers report what they did since a snapshot so the totals cover the whole run
+    def snapshot(self):
+        with self.lock:
+            return OrderedDict([(name, dict(stage)) for name, stage in self.stages.items()])
+
+    def since(self, snapshot):
+        stages = OrderedDict()
+        for name, stage in self.snapshot().items():
+            before = snapshot.get(name, {"seconds": 0.0, "calls": 0, "bytes": 0})
+            stages[name] = {
+                "seconds": stage["seconds"] - before["seconds"],
+                "calls": stage["calls"] - before["calls"],
+                "bytes": stage["bytes"] - before["bytes"],
+                "peakRss": stage["peakRss"]
+            }
+        return stages
+
+    def addStages(self, stages):
+        with self.lock:
+            for name, stage in stages.items():
+                if name not in self.stages:
+                    self.stages[name] = {"seconds": 0.0, "calls": 0, "bytes": 0, "peakRss": 0}
+                self.stages[name]["seconds"] += stage["seconds"]
+                self.stages[name]["calls"] += stage["calls"]
+                self.stages[name]["bytes"] += stage["bytes"]
+                self.stages[name]["peakRss"] = max(self.stages[name]["peakRss"], stage["peakRss"])
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"stages": self.snapshot(), "peakRss": peakRss()}, f, indent=2)
+
+# One timer per process, shared by the modules that do the work
+timer = StageTimer()
+
+# Writes one JSON line per traced event, e.g. a sheet or binder, with the time it took in each stage and the memory it peaked at
+# An event's stages also count work other threads of the process did meanwhile, e.g. pages decoded ahead
+# Events of worker processes are kept until the worker hands them back with takeEvents(); only the process that opened the trace writes
+class Trace(object):
+
+    # Without write, events are only collected, e.g. in a worker process that hands them back with takeEvents
+    def __init__(self, filename=None, write=True):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+        self.file = None
+        if filename:
+            if write:
+                self.file = open(filename, "w")
+            if tracemalloc is not None and not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    # Yields the event so the caller can add fields such as bytes written
+    @contextmanager
+    def event(self, kind, name):
+        if not self.filename:
+            yield {}
+            return
+        event = {"event": kind, "file": name}
+        stages = timer.snapshot()
+        if tracemalloc is not None and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start = time.time()
+        try:
+            yield event
+        finally:
+            end = time.time()
+            event["start"] = start
+            event["end"] = end
+            event["seconds"] = end - start
+            event["stages"] = dict([(stageName, stage["seconds"]) for stageName, stage in timer.since(stages).items() if stage["calls"] > 0])
+            if tracemalloc is not None:
+                event["tracemallocPeak"] = tracemalloc.get_traced_memory()[1]
+            else:
+                event["peakRss"] = peakRss()
+            event["pid"] = os.getpid()
+            self.addEvents([event])
+
+    def addEvents(self, events):
+        with self.lock:
+            self.events += events
+            if self.file is not None and os.getpid() == self.pid:
+                for event in self.events:
+                    self.file.write(json.dumps(event, sort_keys=True) + "\n")
+                self.file.flush()
+                self.events = []
+
+    def takeEvents(self):
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
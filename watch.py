@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# Description: polls files for changes so a build can run again in the same process, with its caches still warm
+# Polling needs nothing beyond the standard library and notices a save within one interval
+
+import os
+import time
+
+class Watcher(object):
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.stamps = {} # file => (modification time, size), or None if it does not exist
+
+    def stamp(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    # Starts watching files as they are now; files already watched keep their last seen state
+    def add(self, filenames):
+        for filename in filenames:
+            if filename not in self.stamps:
+                self.stamps[filename] = self.stamp(filename)
+
+    # Waits until any of the files is created, changed or deleted, and returns those that were
+    def wait(self, filenames):
+        self.add(filenames)
+        while True:
+            time.sleep(self.interval)
+            changed = [filename for filename in filenames if self.stamp(filename) != self.stamps[filename]]
+            if len(changed):
+                break
+
+        # wait until the files stop changing, e.g. while an editor is still saving
+        stamps = dict([(filename, self.stamp(filename)) for filename in filenames])
+        while True:
+            time.sleep(self.interval)
+            current = dict([(filename, self.stamp(filename)) for filename in filenames])
+            if current == stamps:
+                break
+            changed += [filename for filename in filenames if current[filename] != stamps[filename] and filename not in changed]
+            stamps = current
+
+        self.stamps.update(stamps)
+        return changed